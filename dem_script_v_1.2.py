@@ -1,12 +1,28 @@
 import requests
+import json
+import gzip
+import hashlib
+import os
+import sys
 import time
+import threading
+import cProfile
+import pstats
+import tracemalloc
 import logging
+import logging.handlers
+import queue
+import atexit
 from datetime import datetime, timedelta, timezone
-from collections import defaultdict
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
+from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
 from openpyxl.chart import BarChart, Reference
+from openpyxl.formatting.rule import FormulaRule
+from openpyxl.utils import get_column_letter
 from openpyxl.utils.dataframe import dataframe_to_rows
 
 # 🔥 Disable SSL warnings
@@ -18,11 +34,44 @@ API_TOKEN = "13342187c927b00bdfa826e31218f"
 LIMIT = 100
 MAX_WINDOW_SECONDS = 48 * 3600
 TIME_RANGES = {'1day': 1, '7days': 7, '30days': 30}
+MAX_ROWS_PER_SHEET = 1_000_000    # Excel hard limit is 1,048,576 rows incl. header
+SHEETS_PER_WORKBOOK = 1           # User Data sheets per workbook before starting a new file
+SHARD_WORKERS = os.cpu_count() or 1
+WIDTH_SAMPLE_ROWS = 5000          # rows sampled per column when sizing widths
+QUIET_MODE = False                # unattended runs: no per-page progress lines
+PROGRESS_REFRESH_SECONDS = 1.0    # minimum interval between progress lines
+DRY_RUN = False                   # only probe the windows and print the fetch plan
+PLAN_BEFORE_FETCH = True          # probe windows first so progress and ETA count real API calls
+PAGE_DELAY_SECONDS = 1
+RECORD_MEMORY_FACTOR = 6.0        # in-memory size of a parsed record relative to its JSON size
+XLSX_BYTES_FACTOR = 0.4           # compressed xlsx bytes per JSON byte of a record
+MERGE_STRATEGY = 'mean'           # expScore across duplicate records: first, last, max, min or mean
+MERGE_STRATEGIES = ('first', 'last', 'max', 'min', 'mean')
+PROFILE_MODE = False              # per-stage cProfile, sampled stacks and tracemalloc written to profile_<timestamp>/
+PROFILE_MEMORY = True             # include tracemalloc in PROFILE_MODE (slows the run noticeably)
+PROFILE_SAMPLE_INTERVAL = 0.005   # seconds between stack samples for the collapsed-stack files
+RECORD_DIR = None                 # save every raw API page under this directory for offline replay
+REPLAY_DIR = None                 # read pages from a recording instead of the API (no network, no page delay)
 
-logging.basicConfig(filename='netskope_run.log', level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+HEADER_STYLE = "dem_header"
+THIN_SIDE = Side(style='thin')
+GRID_BORDER = Border(left=THIN_SIDE, right=THIN_SIDE, top=THIN_SIDE, bottom=THIN_SIDE)
+
+# Log records are handed to a queue; a background listener does the file I/O
+log_queue = queue.SimpleQueue()
+log_file_handler = logging.FileHandler('netskope_run.log')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_file_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 
 errors, api_durations = [], []
+last_progress_print = [0.0]
+profile_state = {'stage': None, 'results': [], 'timers': {}, 'stacks': {}, 'sampler': None,
+                 'stop': threading.Event(), 'dir': f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}"}
 
 def datetime_to_epoch(dt):
     return int(dt.timestamp())
@@ -32,36 +81,183 @@ def clean_group_name(name):
         return name.split('/')[-1]
     return name
 
+def print_progress(message, force=False):
+    if QUIET_MODE:
+        return
+    now = time.monotonic()
+    if force or now - last_progress_print[0] >= PROGRESS_REFRESH_SECONDS:
+        last_progress_print[0] = now
+        print(message)
+
+@contextmanager
+def profile_timer(name):
+    # Accumulates time for steps inside a stage (network, decode, merge); no-op unless PROFILE_MODE
+    if not PROFILE_MODE:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = profile_state['timers'].setdefault(name, [0.0, 0])
+        entry[0] += time.perf_counter() - started
+        entry[1] += 1
+
+def sample_stacks(interval):
+    # Collapsed stacks of the main thread for the running stage; save_to_excel's worker processes are not sampled
+    main = threading.main_thread().ident
+    while not profile_state['stop'].wait(interval):
+        stage = profile_state['stage']
+        frame = sys._current_frames().get(main)
+        if stage is None or frame is None:
+            continue
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        profile_state['stacks'][stage][';'.join(stack[::-1])] += 1
+
+@contextmanager
+def profile_stage(name):
+    if not PROFILE_MODE:
+        yield
+        return
+    os.makedirs(profile_state['dir'], exist_ok=True)
+    if profile_state['sampler'] is None:
+        profile_state['sampler'] = threading.Thread(target=sample_stacks, args=(PROFILE_SAMPLE_INTERVAL,), daemon=True)
+        profile_state['sampler'].start()
+    if PROFILE_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+    profile_state['stacks'].setdefault(name, Counter())
+    profile_state['stage'] = name
+    profile = cProfile.Profile()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        result = {'stage': name, 'wall': time.perf_counter() - wall_start, 'cpu': time.process_time() - cpu_start,
+                  'mem_delta': None, 'mem_peak': None, 'top': ''}
+        profile_state['stage'] = None
+        profile.dump_stats(os.path.join(profile_state['dir'], f"{name}.pstats"))
+        stats = pstats.Stats(profile).stats
+        if stats:
+            (filename, line, func), row = max(stats.items(), key=lambda item: item[1][2])
+            result['top'] = f"{func} ({os.path.basename(filename)}:{line}) {row[2]:.2f}s"
+        if PROFILE_MEMORY:
+            current, peak = tracemalloc.get_traced_memory()
+            result['mem_delta'], result['mem_peak'] = current - memory_before, peak - memory_before
+            with open(os.path.join(profile_state['dir'], f"{name}.tracemalloc.txt"), 'w', encoding='utf-8') as f:
+                f.write('\n'.join(str(stat) for stat in tracemalloc.take_snapshot().statistics('lineno')[:25]) + '\n')
+        profile_state['results'].append(result)
+
+def close_profile():
+    if not PROFILE_MODE or not profile_state['results']:
+        return
+    profile_state['stop'].set()
+    if profile_state['sampler'] is not None:
+        profile_state['sampler'].join()
+    out_dir = profile_state['dir']
+    with open(os.path.join(out_dir, "all.collapsed"), 'w', encoding='utf-8') as combined:
+        for stage, counter in profile_state['stacks'].items():
+            with open(os.path.join(out_dir, f"{stage}.collapsed"), 'w', encoding='utf-8') as f:
+                for stack, count in counter.most_common():
+                    f.write(f"{stack} {count}\n")
+                    combined.write(f"{stage};{stack} {count}\n")
+
+    def fmt(size):
+        return '-' if size is None else ('-' if size < 0 else '') + format_bytes(abs(size))
+    lines = [f"{'Stage':<18}{'Wall s':>9}{'CPU s':>9}{'Mem Δ':>12}{'Mem peak':>12}{'Samples':>9}  Top function (tottime)"]
+    for r in profile_state['results']:
+        samples = sum(profile_state['stacks'][r['stage']].values())
+        lines.append(f"{r['stage']:<18}{r['wall']:>9.2f}{r['cpu']:>9.2f}{fmt(r['mem_delta']):>12}"
+                     f"{fmt(r['mem_peak']):>12}{samples:>9}  {r['top']}")
+    if profile_state['timers']:
+        lines.append("")
+        lines.append(f"{'Timer':<18}{'Total s':>9}{'Calls':>9}{'Avg ms':>12}")
+        for name, (seconds, calls) in sorted(profile_state['timers'].items(), key=lambda item: -item[1][0]):
+            lines.append(f"{name:<18}{seconds:>9.2f}{calls:>9}{seconds / calls * 1000:>12.2f}")
+    summary = '\n'.join(lines)
+    with open(os.path.join(out_dir, "summary.txt"), 'w', encoding='utf-8') as f:
+        f.write(summary + '\n')
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    print(f"\n=== Profile ({out_dir}) ===\n{summary}")
+
+def page_path(directory, payload):
+    # The file name is the index: one gzip JSON page per (window, offset, limit)
+    name = f"{payload['starttime']}_{payload['endtime']}_{payload['offset']}_{payload['limit']}.json.gz"
+    return os.path.join(directory, 'pages', name)
+
+def record_page(payload, data):
+    path = page_path(RECORD_DIR, payload)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with gzip.open(f"{path}.tmp", 'wt', encoding='utf-8') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(f"{path}.tmp", path)
+
+def replay_page(payload):
+    path = page_path(REPLAY_DIR, payload)
+    if not os.path.exists(path):
+        raise LookupError(f"No recorded page for {payload} in {REPLAY_DIR}")
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+def write_meta(directory, **meta):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(meta, api_url=API_URL, recorded_at=datetime.now(tz=timezone.utc).isoformat()),
+                  f, indent=2, default=str)
+
+def read_meta(directory):
+    with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+        return json.load(f)
+
 def fetch_data(starttime, endtime, total_calls, current_call):
     offset, all_users = 0, []
     while True:
         payload = {"starttime": starttime, "endtime": endtime, "limit": LIMIT, "offset": offset}
         call_start = time.time()
-        try:
-            response = requests.post(API_URL, headers={"Authorization": f"Bearer {API_TOKEN}",
-                                                       "Content-Type": "application/json"},
-                                     json=payload, verify=False)  # 🔧 PATCHED LINE
-        except Exception as e:
-            errors.append(str(e))
-            logging.error(str(e))
-            break
-        duration = time.time() - call_start
-        api_durations.append(duration)
+        if REPLAY_DIR:
+            with profile_timer('decode'):
+                data = replay_page(payload)
+            duration = time.time() - call_start
+            api_durations.append(duration)
+        else:
+            try:
+                with profile_timer('network'):
+                    response = requests.post(API_URL, headers={"Authorization": f"Bearer {API_TOKEN}",
+                                                               "Content-Type": "application/json"},
+                                             json=payload, verify=False)  # 🔧 PATCHED LINE
+            except Exception as e:
+                errors.append(str(e))
+                logging.error(str(e))
+                break
+            duration = time.time() - call_start
+            api_durations.append(duration)
 
-        if response.status_code == 429:
-            retry_after = int(response.headers.get('Retry-After', '1'))
-            errors.append(f"429 Too Many Requests. Waiting {retry_after}s...")
-            time.sleep(retry_after)
-            continue
-        if 500 <= response.status_code < 600:
-            errors.append(f"Server error {response.status_code}")
-            time.sleep(5)
-            continue
-        if response.status_code != 200:
-            errors.append(f"Error {response.status_code}: {response.text}")
-            break
+            if response.status_code == 429:
+                retry_after = int(response.headers.get('Retry-After', '1'))
+                errors.append(f"429 Too Many Requests. Waiting {retry_after}s...")
+                time.sleep(retry_after)
+                continue
+            if 500 <= response.status_code < 600:
+                errors.append(f"Server error {response.status_code}")
+                time.sleep(5)
+                continue
+            if response.status_code != 200:
+                errors.append(f"Error {response.status_code}: {response.text}")
+                break
 
-        data = response.json()
+            with profile_timer('decode'):
+                data = response.json()
+            if RECORD_DIR:
+                record_page(payload, data)
         users = data.get('users', [])
         if not users:
             break
@@ -72,33 +268,161 @@ def fetch_data(starttime, endtime, total_calls, current_call):
         progress_pct = (current_call[0] / total_calls) * 100
         avg_dur = sum(api_durations) / len(api_durations)
         eta = avg_dur * (total_calls - current_call[0])
-        print(f"Progress: {progress_pct:.1f}% — ETA: {timedelta(seconds=int(eta))}")
-        logging.info(f"Page {offset}, duration={duration:.2f}s, progress={progress_pct:.1f}%")
+        print_progress(f"Progress: {progress_pct:.1f}% — ETA: {timedelta(seconds=int(eta))}")
+        logging.info("Page %d, duration=%.2fs, progress=%.1f%%", offset, duration, progress_pct)
 
         current_call[0] += 1
         if offset >= total:
             break
-        time.sleep(1)
+        if not REPLAY_DIR:
+            time.sleep(PAGE_DELAY_SECONDS)
     return all_users
 
-def aggregate_users(raw_users):
-    agg = defaultdict(lambda: {'userGroups': set(), 'expScores': [], 'applications': set(),
-                               'devices': set(), 'locations': set()})
+def time_windows(days, end=None):
+    # Oldest window first, the order v3.1 fetches in, so 'first' and 'last' merges keep the same record
+    end = end or datetime.now(tz=timezone.utc)
+    chunk_start = end - timedelta(days=days)
+    windows = []
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(seconds=MAX_WINDOW_SECONDS), end)
+        windows.append((chunk_start, chunk_end))
+        chunk_start = chunk_end
+    return windows
+
+def probe_window(starttime, endtime):
+    payload = {"starttime": starttime, "endtime": endtime, "limit": 1, "offset": 0}
+    call_start = time.time()
+    if REPLAY_DIR:
+        data = replay_page(payload)
+        return {'total': int(data.get('totalUsersCount') or 0), 'latency': time.time() - call_start,
+                'record_bytes': [len(json.dumps(u)) for u in data.get('users', [])]}
+    while True:
+        call_start = time.time()
+        try:
+            response = requests.post(API_URL, headers={"Authorization": f"Bearer {API_TOKEN}",
+                                                       "Content-Type": "application/json"},
+                                     json=payload, verify=False)
+        except Exception as e:
+            errors.append(str(e))
+            logging.error(str(e))
+            return None
+        latency = time.time() - call_start
+        # Same retry rules as fetch_data, so a throttled probe doesn't plan its window as empty
+        if response.status_code == 429:
+            retry_after = int(response.headers.get('Retry-After', '1'))
+            errors.append(f"Probe 429 Too Many Requests. Waiting {retry_after}s...")
+            time.sleep(retry_after)
+            continue
+        if 500 <= response.status_code < 600:
+            errors.append(f"Probe server error {response.status_code}")
+            time.sleep(5)
+            continue
+        if response.status_code != 200:
+            errors.append(f"Probe error {response.status_code}: {response.text}")
+            return None
+        break
+    data = response.json()
+    if RECORD_DIR:
+        record_page(payload, data)
+    return {'total': int(data.get('totalUsersCount') or 0), 'latency': latency,
+            'record_bytes': [len(json.dumps(u)) for u in data.get('users', [])]}
+
+def plan_fetch(windows, concurrency=1):
+    plan_windows, latencies, record_bytes, failed = [], [], [], 0
+    for n, (chunk_start, chunk_end) in enumerate(windows):
+        if n and not REPLAY_DIR:
+            time.sleep(PAGE_DELAY_SECONDS)
+        probe = probe_window(datetime_to_epoch(chunk_start), datetime_to_epoch(chunk_end))
+        total = probe['total'] if probe else 0
+        if probe:
+            latencies.append(probe['latency'])
+            record_bytes.extend(probe['record_bytes'])
+        else:
+            failed += 1
+        # fetch_data stops once offset passes totalUsersCount; an empty window still costs one call
+        pages = -(-total // LIMIT)
+        plan_windows.append({'start': chunk_start, 'end': chunk_end, 'total_users': total,
+                             'pages': pages, 'api_calls': max(pages, 1)})
+    api_calls = sum(w['api_calls'] for w in plan_windows)
+    records = sum(w['total_users'] for w in plan_windows)
+    avg_latency = sum(latencies) / len(latencies) if latencies else 0.0
+    avg_record = sum(record_bytes) / len(record_bytes) if record_bytes else 0.0
+    page_delays = sum(w['api_calls'] - 1 for w in plan_windows) * PAGE_DELAY_SECONDS
+    return {'windows': plan_windows, 'probe_calls': len(windows), 'failed_probes': failed, 'api_calls': api_calls,
+            'records': records, 'avg_latency': avg_latency, 'concurrency': max(1, concurrency),
+            'est_seconds': (api_calls * avg_latency + page_delays) / max(1, concurrency),
+            'est_memory_bytes': int(records * avg_record * RECORD_MEMORY_FACTOR),
+            'est_output_bytes': int(records * avg_record * XLSX_BYTES_FACTOR)}
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def print_plan(plan):
+    print("\n=== Fetch Plan ===")
+    for w in plan['windows']:
+        print(f"{w['start']} → {w['end']}: {w['total_users']} records, {w['pages']} pages, {w['api_calls']} calls")
+    print(f"Probe calls used: {plan['probe_calls']}")
+    if plan['failed_probes']:
+        print(f"⚠️ {plan['failed_probes']} probe(s) failed; those windows are counted as one call each")
+    print(f"Expected API calls: {plan['api_calls']}")
+    print(f"Records across windows: {plan['records']}")
+    print(f"Measured latency: {plan['avg_latency']:.2f}s per call, concurrency {plan['concurrency']}")
+    print(f"Projected runtime: {timedelta(seconds=int(plan['est_seconds']))}")
+    print(f"Estimated memory: {format_bytes(plan['est_memory_bytes'])}")
+    print(f"Estimated output size: {format_bytes(plan['est_output_bytes'])}")
+
+def normalize_user_key(value):
+    return str(value or '').strip().lower()
+
+def user_key_id(normalized):
+    # 64-bit id instead of the email string as the dict key
+    return int.from_bytes(hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+def new_aggregate():
+    return defaultdict(lambda: {'user': None, 'userGroups': set(), 'score': None, 'scoreTotal': 0, 'scoreCount': 0,
+                                'applications': set(), 'devices': set(), 'locations': set()})
+
+def merge_users(agg, raw_users, strategy=MERGE_STRATEGY):
+    if strategy not in MERGE_STRATEGIES:
+        raise ValueError(f"Unknown merge strategy {strategy!r}, expected one of {', '.join(MERGE_STRATEGIES)}")
     for user in raw_users:
-        u = user.get('user', '')
-        agg[u]['userGroups'].update(filter(None, user.get('userGroups', [])))
         exp = user.get('expScore')
-        if exp is not None:
-            agg[u]['expScores'].append(exp)
-        agg[u]['applications'].update(filter(None, user.get('applications', [])))
-        agg[u]['devices'].update([d.get('deviceName', '') for d in user.get('devices', []) if d.get('deviceName')])
+        # Same rule as the v3.1 report: records without a positive score are dropped before merging
+        if exp is None or exp <= 0:
+            continue
+        display = user.get('user', '')
+        entry = agg[user_key_id(normalize_user_key(display))]
+        if entry['user'] is None:
+            entry['user'] = display
+        entry['userGroups'].update(filter(None, user.get('userGroups', [])))
+        entry['scoreTotal'] += exp
+        entry['scoreCount'] += 1
+        current = entry['score']
+        if (current is None or strategy == 'last'
+                or (strategy == 'max' and exp > current) or (strategy == 'min' and exp < current)):
+            entry['score'] = exp
+        entry['applications'].update(filter(None, user.get('applications', [])))
+        entry['devices'].update([d.get('deviceName', '') for d in user.get('devices', []) if d.get('deviceName')])
         loc = user.get('location', '')
         if loc:
-            agg[u]['locations'].add(loc)
+            entry['locations'].add(loc)
+    return agg
 
+def aggregate_users(raw_users, strategy=MERGE_STRATEGY):
+    return build_user_frame(merge_users(new_aggregate(), raw_users, strategy), strategy)
+
+def build_user_frame(agg, strategy=MERGE_STRATEGY):
     final_data = []
-    for user, details in agg.items():
-        avg_expScore = round(sum(details['expScores']) / len(details['expScores'])) if details['expScores'] else ''
+    for details in agg.values():
+        user = details['user']
+        if strategy == 'mean':
+            avg_expScore = round(details['scoreTotal'] / details['scoreCount'])
+        else:
+            avg_expScore = round(details['score'])
         apps = sorted(details['applications'])
         devs = sorted(details['devices'])
         locs = sorted(details['locations'])
@@ -113,34 +437,50 @@ def aggregate_users(raw_users):
                                'locations': ','.join(locs)})
     return pd.DataFrame(final_data)
 
-def save_to_excel(df_users, filename_xlsx):
-    df_users['expScore'] = pd.to_numeric(df_users['expScore'], errors='coerce').round(0).astype('Int64')
-    df_avg = df_users.groupby("userGroup").agg(
-        average_expScore=("expScore", "mean"),
-        user_count=("user", "count")
-    ).reset_index()
-    df_avg['average_expScore'] = df_avg['average_expScore'].round(0).astype('Int64')
-    df_chart = df_avg.sort_values(by="average_expScore", ascending=False)
+def shard_frame(df, rows_per_shard):
+    rows_per_shard = max(1, rows_per_shard)
+    return [df.iloc[i:i + rows_per_shard] for i in range(0, max(len(df), 1), rows_per_shard)]
+
+def shard_filename(filename_xlsx, part, total_parts):
+    if total_parts <= 1:
+        return filename_xlsx
+    root, ext = os.path.splitext(filename_xlsx)
+    return f"{root}_part{part}of{total_parts}{ext or '.xlsx'}"
+
+def header_style():
+    return NamedStyle(name=HEADER_STYLE, font=Font(bold=True, color="FFFFFF"),
+                      fill=PatternFill("solid", fgColor="4F81BD"), alignment=Alignment(horizontal="center"))
+
+def column_widths(df, sample_rows=WIDTH_SAMPLE_ROWS):
+    if len(df) > sample_rows:
+        half = sample_rows // 2
+        df = pd.concat([df.head(half), df.iloc[half:].sample(sample_rows - half, random_state=0)])
+    widths = []
+    for col in df.columns:
+        values = df[col].astype(object).where(df[col].notna(), "")
+        lengths = values.astype(str).str.len()
+        widths.append(max(len(str(col)), int(lengths.max()) if len(lengths) else 0))
+    return widths
 
+def write_workbook(user_shards, df_avg, df_chart, filename_xlsx):
     wb = openpyxl.Workbook()
-    ws1 = wb.active
-    ws1.title = "User Data"
+    wb.add_named_style(header_style())
+    user_sheets = [wb.active]
+    user_sheets[0].title = "User Data"
+    for n in range(2, len(user_shards) + 1):
+        user_sheets.append(wb.create_sheet(f"User Data {n}"))
     ws2 = wb.create_sheet("Group_Averages")
     ws3 = wb.create_sheet("Group_Chart")
 
-    for sheet, df in zip([ws1, ws2, ws3], [df_users, df_avg, df_chart]):
+    for sheet, df in zip(user_sheets + [ws2, ws3], list(user_shards) + [df_avg, df_chart]):
         for r in dataframe_to_rows(df, index=False, header=True):
             sheet.append(r)
         for cell in sheet[1]:
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill("solid", fgColor="4F81BD")
-            cell.alignment = Alignment(horizontal="center")
-        for col in sheet.columns:
-            max_len = max(len(str(cell.value or "")) for cell in col)
-            sheet.column_dimensions[col[0].column_letter].width = max_len + 2
-            for cell in col:
-                cell.border = Border(left=Side(style='thin'), right=Side(style='thin'),
-                                     top=Side(style='thin'), bottom=Side(style='thin'))
+            cell.style = HEADER_STYLE
+        for idx, width in enumerate(column_widths(df), 1):
+            sheet.column_dimensions[get_column_letter(idx)].width = width + 2
+        # A single range rule draws the grid instead of a Border object on every cell
+        sheet.conditional_formatting.add(sheet.dimensions, FormulaRule(formula=['TRUE'], border=GRID_BORDER))
 
     chart = BarChart()
     chart.title = "Average Experience Score by Group (Sorted)"
@@ -156,31 +496,92 @@ def save_to_excel(df_users, filename_xlsx):
     ws3.add_chart(chart, "E5")
 
     wb.save(filename_xlsx)
+    return filename_xlsx
 
-def fetch_and_save(days, filename_xlsx):
-    now, end, start = datetime.now(tz=timezone.utc), datetime.now(tz=timezone.utc), datetime.now(tz=timezone.utc) - timedelta(days=days)
-    all_raw_data, total_chunks = [], (days * 86400) // MAX_WINDOW_SECONDS + 1
-    total_calls, current_call = total_chunks * 200, [1]
-
-    while end > start:
-        chunk_start = max(end - timedelta(seconds=MAX_WINDOW_SECONDS), start)
-        s_epoch, e_epoch = datetime_to_epoch(chunk_start), datetime_to_epoch(end)
-        print(f"📦 Fetching {chunk_start} → {end}")
-        logging.info(f"Chunk {chunk_start} → {end}")
-        all_raw_data.extend(fetch_data(s_epoch, e_epoch, total_calls, current_call))
-        end = chunk_start
-
-    df_users = aggregate_users(all_raw_data)
-    save_to_excel(df_users, filename_xlsx)
-
-    print("\n=== Run Summary ===")
-    print(f"Total API calls: {len(api_durations)}")
-    print(f"Avg API call time: {sum(api_durations)/len(api_durations):.2f}s" if api_durations else "No calls")
-    print(f"Total errors: {len(errors)}")
-    for err in errors:
-        print(f"⚠️ {err}")
+def save_to_excel(df_users, filename_xlsx, max_rows_per_sheet=MAX_ROWS_PER_SHEET,
+                  sheets_per_workbook=SHEETS_PER_WORKBOOK, workers=SHARD_WORKERS):
+    df_users['expScore'] = pd.to_numeric(df_users['expScore'], errors='coerce').round(0).astype('Int64')
+    df_avg = df_users.groupby("userGroup").agg(
+        average_expScore=("expScore", "mean"),
+        user_count=("user", "count")
+    ).reset_index()
+    df_avg['average_expScore'] = df_avg['average_expScore'].round(0).astype('Int64')
+    df_chart = df_avg.sort_values(by="average_expScore", ascending=False)
+
+    # Group sheets are computed over the whole tenant and repeated in every workbook,
+    # only the User Data rows are split.
+    sheet_shards = shard_frame(df_users, max_rows_per_sheet)
+    sheets_per_workbook = max(1, sheets_per_workbook)
+    book_shards = [sheet_shards[i:i + sheets_per_workbook]
+                   for i in range(0, len(sheet_shards), sheets_per_workbook)]
+    filenames = [shard_filename(filename_xlsx, n, len(book_shards)) for n in range(1, len(book_shards) + 1)]
+
+    if len(book_shards) == 1 or workers <= 1:
+        return [write_workbook(shards, df_avg, df_chart, name) for shards, name in zip(book_shards, filenames)]
+
+    logging.info(f"Writing {len(df_users)} rows as {len(sheet_shards)} sheets in {len(book_shards)} workbooks "
+                 f"using {min(workers, len(book_shards))} processes")
+    with ProcessPoolExecutor(max_workers=min(workers, len(book_shards))) as pool:
+        futures = [pool.submit(write_workbook, shards, df_avg, df_chart, name)
+                   for shards, name in zip(book_shards, filenames)]
+        return [f.result() for f in futures]
+
+def fetch_and_save(days, filename_xlsx, dry_run=DRY_RUN, plan_first=PLAN_BEFORE_FETCH):
+    try:
+        if REPLAY_DIR:
+            # Replay the recorded windows exactly; their page files are keyed by epoch bounds
+            meta = read_meta(REPLAY_DIR)
+            windows = time_windows(days, datetime.fromisoformat(meta['end']))
+            # Probe pages only exist if the recorded run planned
+            plan_first = meta.get('planned', True)
+        else:
+            windows = time_windows(days)
+        plan = None
+        if RECORD_DIR:
+            write_meta(RECORD_DIR, days=days, filename=filename_xlsx, end=windows[-1][1].isoformat(),
+                       planned=dry_run or plan_first)
+        if dry_run or plan_first:
+            with profile_stage('plan'):
+                plan = plan_fetch(windows)
+            print_plan(plan)
+        if dry_run:
+            return
+        agg = new_aggregate()
+        # Without a plan, progress falls back to a rough guess of 200 calls per window
+        total_calls, current_call = max(plan['api_calls'], 1) if plan else len(windows) * 200, [1]
+
+        with profile_stage('fetch'):
+            for chunk_start, end in windows:
+                s_epoch, e_epoch = datetime_to_epoch(chunk_start), datetime_to_epoch(end)
+                print_progress(f"📦 Fetching {chunk_start} → {end}", force=True)
+                logging.info(f"Chunk {chunk_start} → {end}")
+                users = fetch_data(s_epoch, e_epoch, total_calls, current_call)
+                with profile_timer('merge_users'):
+                    merge_users(agg, users)
+
+        with profile_stage('aggregate_users'):
+            df_users = build_user_frame(agg)
+        with profile_stage('save_to_excel'):
+            written_files = save_to_excel(df_users, filename_xlsx)
+        for written in written_files:
+            print(f"💾 Saved {written}")
+
+        print("\n=== Run Summary ===")
+        print(f"Total API calls: {len(api_durations)}")
+        print(f"Avg API call time: {sum(api_durations)/len(api_durations):.2f}s" if api_durations else "No calls")
+        print(f"Total errors: {len(errors)}")
+        for err in errors:
+            print(f"⚠️ {err}")
+    finally:
+        # Also on errors and Ctrl-C, which is when a profile of a slow fetch matters most
+        close_profile()
 
 def main():
+    if REPLAY_DIR:
+        meta = read_meta(REPLAY_DIR)
+        print(f"⏪ Replaying {meta['days']} day(s) recorded {meta['recorded_at']} from {REPLAY_DIR}")
+        fetch_and_save(meta['days'], meta['filename'])
+        return
     print("Select time range to pull:\n1 → last 1 day\n2 → last 7 days\n3 → last 30 days")
     choice = input("Enter choice (1/2/3): ").strip()
     if choice == '1':
@@ -8,31 +8,616 @@ API_URL = "https://eliterhythm.goskope.com/api/v2/adem/users/getentities"
 API_TOKEN = "12343212ss98765sa54a0s0s0d252576"
 SORT_ORDER = "desc"
 DEBUG_MODE = True
+QUIET_MODE = False                # unattended runs: no console logging, progress bars or per-batch lines
+PROGRESS_REFRESH_SECONDS = 1.0    # minimum interval between per-batch progress lines
+DRY_RUN = False                   # only probe the windows and print the fetch plan
+PLAN_BEFORE_FETCH = True          # probe windows first so progress and ETA count real API calls
+ADAPTIVE_WINDOWS = True           # size windows from probed density (needs PLAN_BEFORE_FETCH or DRY_RUN)
+CONCURRENCY = 1                   # time windows fetched in parallel
+DIFF_MODE = True                  # compare against the previous run's snapshot and write a diff report
+SNAPSHOT_FILE = "netskope_snapshot.json.gz"  # one baseline per range length and filter, suffixed with a scope hash
+DIFF_MIN_SCORE_CHANGE = 5         # smallest per-user score change listed as changed
+TREND_TOP_GROUPS = 10             # groups (by user count) charted on the Trends sheet
+MERGE_STRATEGY = "first"          # duplicate users across windows: first, last, max, min or mean expScore
+MERGE_SPILL_AFTER = 0             # unique users held in memory before spilling to a temp SQLite file; 0 = never
+FILTER_GROUPS = []                # keep users in any of these groups (full path or last segment)
+FILTER_LOCATIONS = []             # keep users at any of these locations
+FILTER_APPLICATIONS = []          # keep users of any of these applications
+FILTER_MIN_SCORE = None           # inclusive expScore band; users with expScore <= 0 are always dropped
+FILTER_MAX_SCORE = None
+PROJECT_FIELDS = None             # extra raw fields kept per record, e.g. ['devices']; None keeps all.
+                                  # Report columns built from dropped fields are left out of the report
+TOP_N_MODE = False                # compact worst-N report from bounded heaps instead of the full report
+TOP_N_USERS = 500                 # worst users overall
+TOP_N_GROUPS = 50                 # worst groups by average score
+TOP_N_PER_KEY = 10                # worst users kept per group and per location
+TOP_N_EARLY_STOP = True           # fetch ascending and stop paging a window once no record can enter any worst-N heap
+                                  # (serial fetches only; group/location sheets are omitted if a window stops early)
+PROFILE_MODE = False              # per-stage cProfile, sampled stacks and tracemalloc written to profile_<timestamp>/
+PROFILE_MEMORY = True             # include tracemalloc in PROFILE_MODE (slows the run noticeably)
+PROFILE_SAMPLE_INTERVAL = 0.005   # seconds between stack samples for the collapsed-stack files
+RECORD_DIR = None                 # save every raw API page under this directory for offline replay
+REPLAY_DIR = None                 # read pages from a recording instead of the API (uses the recorded range, windows and sort)
+SERVE_MODE = False                # run the local report server instead of the interactive report
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+CACHE_TTL_SECONDS = 300           # refresh interval for cached windows that end within the last hour
+CACHE_MAX_WINDOWS = 500           # windows kept in the server's page cache
 # =================================================
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import gzip
+import hashlib
+import heapq
+import itertools
+import io
+import sys
+import cProfile
+import pstats
+import tracemalloc
+import sqlite3
+import tempfile
+import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
 import pandas as pd
 from datetime import datetime, timedelta, timezone
 import os
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional
 import time
 from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment
-from openpyxl.chart import BarChart, Reference
+from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
+from openpyxl.utils import get_column_letter
+from openpyxl.chart import BarChart, LineChart, Reference
 from openpyxl.chart.label import DataLabelList
 import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import atexit
 from tqdm import tqdm
 from colorama import init, Fore, Style
 from urllib.parse import urlparse
 
 init(autoreset=True)
 log_level = logging.DEBUG if DEBUG_MODE else logging.INFO
-logging.basicConfig(level=log_level,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.FileHandler('netskope_debug.log'), logging.StreamHandler()])
+# Records are queued on the calling thread and written to file/console by a background listener
+log_queue = queue.SimpleQueue()
+log_handlers = [logging.FileHandler('netskope_debug.log')]
+if not QUIET_MODE:
+    log_handlers.append(logging.StreamHandler())
+for handler in log_handlers:
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=log_level, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
+class ThrottledPrinter:
+    """Prints progress lines at most once per interval; silent in quiet mode."""
+    def __init__(self, interval: float = PROGRESS_REFRESH_SECONDS, quiet: bool = QUIET_MODE):
+        self.interval = interval
+        self.quiet = quiet
+        self._last = 0.0
+
+    def __call__(self, message: str, force: bool = False):
+        if self.quiet:
+            return
+        now = time.monotonic()
+        if force or now - self._last >= self.interval:
+            self._last = now
+            print(message)
+
+class PipelineProfiler:
+    """Opt-in profiling of the report pipeline, one stage at a time.
+
+    Each stage gets a cProfile dump (.pstats), a sampled collapsed-stack file
+    (.collapsed, for flamegraph.pl or speedscope) and, with PROFILE_MEMORY, the
+    top tracemalloc allocation sites. cProfile only sees the calling thread;
+    the stack sampler also covers ThreadPoolExecutor fetch workers. Timers
+    accumulate time for fine-grained steps inside a stage (network, decode,
+    dedup). Disabled, both context managers do nothing.
+    """
+    def __init__(self, enabled: bool = PROFILE_MODE, output_dir: Optional[str] = None,
+                 sample_interval: float = PROFILE_SAMPLE_INTERVAL, trace_memory: bool = PROFILE_MEMORY):
+        self.enabled = enabled
+        self.output_dir = output_dir or f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.results = []
+        self.timers = {}  # name -> [seconds, calls]
+        self.stacks = {}  # stage -> Counter of collapsed stacks
+        self._stage = None
+        self._sampler = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                entry = self.timers.setdefault(name, [0.0, 0])
+                entry[0] += elapsed
+                entry[1] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        self.stacks.setdefault(name, Counter())
+        self._stage = name
+        profile = cProfile.Profile()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            result = {'stage': name, 'wall': time.perf_counter() - wall_start,
+                      'cpu': time.process_time() - cpu_start, 'mem_delta': None, 'mem_peak': None}
+            self._stage = None
+            profile.dump_stats(os.path.join(self.output_dir, f"{name}.pstats"))
+            stats = pstats.Stats(profile).stats
+            if stats:
+                (filename, line, func), row = max(stats.items(), key=lambda item: item[1][2])
+                result['top'] = f"{func} ({os.path.basename(filename)}:{line}) {row[2]:.2f}s"
+            else:
+                result['top'] = ''
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                result['mem_delta'] = current - memory_before
+                result['mem_peak'] = peak - memory_before
+                top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+                with open(os.path.join(self.output_dir, f"{name}.tracemalloc.txt"), 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(str(stat) for stat in top) + '\n')
+            self.results.append(result)
+
+    def _sample(self):
+        own = threading.get_ident()
+        main = threading.main_thread().ident
+        while not self._stop.wait(self.sample_interval):
+            stage = self._stage
+            if stage is None:
+                continue
+            names = {t.ident: t.name for t in threading.enumerate()}
+            counter = self.stacks[stage]
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, '')
+                if ident == own or not (ident == main or name.startswith('ThreadPoolExecutor')):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                counter[';'.join([name] + stack[::-1])] += 1
+
+    @staticmethod
+    def _format_bytes(size) -> str:
+        if size is None:
+            return '-'
+        return ('-' if size < 0 else '') + FetchPlanner._format_bytes(abs(size))
+
+    def summary(self) -> str:
+        lines = [f"{'Stage':<26}{'Wall s':>9}{'CPU s':>9}{'Mem Δ':>12}{'Mem peak':>12}{'Samples':>9}  Top function (tottime)"]
+        for r in self.results:
+            lines.append(f"{r['stage']:<26}{r['wall']:>9.2f}{r['cpu']:>9.2f}{self._format_bytes(r['mem_delta']):>12}"
+                         f"{self._format_bytes(r['mem_peak']):>12}{sum(self.stacks.get(r['stage'], {}).values()):>9}  {r['top']}")
+        if self.timers:
+            lines.append("")
+            lines.append(f"{'Timer':<26}{'Total s':>9}{'Calls':>9}{'Avg ms':>12}")
+            for name, (seconds, calls) in sorted(self.timers.items(), key=lambda item: -item[1][0]):
+                lines.append(f"{name:<26}{seconds:>9.2f}{calls:>9}{seconds / calls * 1000:>12.2f}")
+        return '\n'.join(lines)
+
+    def close(self):
+        if not self.enabled or not self.results:
+            return
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        with open(os.path.join(self.output_dir, "all.collapsed"), 'w', encoding='utf-8') as combined:
+            for stage, counter in self.stacks.items():
+                with open(os.path.join(self.output_dir, f"{stage}.collapsed"), 'w', encoding='utf-8') as f:
+                    for stack, count in counter.most_common():
+                        f.write(f"{stack} {count}\n")
+                        combined.write(f"{stage};{stack} {count}\n")
+        summary = self.summary()
+        with open(os.path.join(self.output_dir, "summary.txt"), 'w', encoding='utf-8') as f:
+            f.write(summary + '\n')
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        print(f"\n{Fore.CYAN}⏱️  Profile ({self.output_dir}):{Style.RESET_ALL}\n{summary}")
+
+profiler = PipelineProfiler()
+
+class RecordFilter:
+    """Predicate and projection applied to raw records as each page is decoded.
+
+    The predicate is compiled once from the configured criteria, so records
+    outside the requested groups/locations/applications/score band are dropped
+    before they reach dedup, trends or the report. Projection keeps the fields
+    needed for keys, scores and grouping plus any listed in fields; the report
+    leaves out columns whose source fields were dropped.
+    """
+    REQUIRED_FIELDS = ('user', 'expScore', 'userGroups', 'location')
+
+    def __init__(self, groups=None, locations=None, applications=None, min_score=None, max_score=None, fields=None):
+        self.groups = frozenset(g.strip().lower() for g in groups or [])
+        self.locations = frozenset(l.strip().lower() for l in locations or [])
+        self.applications = frozenset(a.strip().lower() for a in applications or [])
+        self.min_score = min_score
+        self.max_score = max_score
+        self.fields = None if fields is None else tuple(dict.fromkeys(self.REQUIRED_FIELDS + tuple(fields)))
+        self.matches = self._compile()
+
+    @classmethod
+    def from_config(cls) -> 'RecordFilter':
+        return cls(FILTER_GROUPS, FILTER_LOCATIONS, FILTER_APPLICATIONS, FILTER_MIN_SCORE, FILTER_MAX_SCORE,
+                   PROJECT_FIELDS)
+
+    def _compile(self):
+        checks = []
+        low, high = self.min_score, self.max_score
+        if low is not None or high is not None:
+            low = float('-inf') if low is None else low
+            high = float('inf') if high is None else high
+            checks.append(lambda user: low <= user['expScore'] <= high)
+        if self.groups:
+            groups = self.groups
+            checks.append(lambda user: any(g and (g.lower() in groups or g.rsplit('/', 1)[-1].lower() in groups)
+                                           for g in user.get('userGroups') or ()))
+        if self.locations:
+            locations = self.locations
+            checks.append(lambda user: (user.get('location') or '').lower() in locations)
+        if self.applications:
+            applications = self.applications
+            checks.append(lambda user: any(a and a.lower() in applications for a in user.get('applications') or ()))
+
+        def matches(user: Dict) -> bool:
+            score = user.get('expScore')
+            if score is None or score <= 0:
+                return False
+            for check in checks:
+                if not check(user):
+                    return False
+            return True
+        return matches
+
+    def project(self, user: Dict) -> Dict:
+        if self.fields is None:
+            return user
+        return {field: user[field] for field in self.fields if field in user}
+
+    def key(self):
+        return (self.groups, self.locations, self.applications, self.min_score, self.max_score, self.fields)
+
+    def describe(self) -> str:
+        parts = [f"{name} in {sorted(values)}" for name, values in
+                 (("group", self.groups), ("location", self.locations), ("application", self.applications)) if values]
+        if self.min_score is not None or self.max_score is not None:
+            parts.append(f"expScore {self.min_score if self.min_score is not None else '-'}"
+                         f"..{self.max_score if self.max_score is not None else '-'}")
+        return ', '.join(parts) if parts else "expScore > 0"
+
+class SpillStore:
+    """SQLite-backed stand-in for RecordMerger's in-memory dict on very large tenants."""
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='netskope_merge_', suffix='.sqlite')
+        os.close(fd)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE merged (id INTEGER PRIMARY KEY, seq INTEGER, total REAL, n INTEGER, record TEXT)")
+        atexit.register(self.close)
+
+    def get(self, key):
+        row = self.conn.execute("SELECT record, total, n, seq FROM merged WHERE id = ?", (key,)).fetchone()
+        return [json.loads(row[0]), row[1], row[2], row[3]] if row else None
+
+    def __setitem__(self, key, entry):
+        record, total, n, seq = entry
+        self.conn.execute("INSERT OR REPLACE INTO merged (id, seq, total, n, record) VALUES (?, ?, ?, ?, ?)",
+                          (key, seq, total, n, json.dumps(record)))
+
+    def values(self):
+        for record, total, n, seq in self.conn.execute("SELECT record, total, n, seq FROM merged ORDER BY seq"):
+            yield [json.loads(record), total, n, seq]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            os.remove(self.path)
+
+class RecordMerger:
+    """Merges duplicate user records across windows with a configurable strategy.
+
+    Users are keyed by a 64-bit hash of the stripped, lowercased email, so the
+    key index costs a small int per user rather than the email string. 'first'
+    and 'last' keep that record; 'max' and 'min' keep the record with the
+    highest/lowest expScore; 'mean' keeps the first record and reports the
+    rounded mean expScore of all its duplicates.
+    """
+    STRATEGIES = ('first', 'last', 'max', 'min', 'mean')
+
+    def __init__(self, strategy: str = MERGE_STRATEGY, spill_after: int = MERGE_SPILL_AFTER):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown merge strategy {strategy!r}, expected one of {', '.join(self.STRATEGIES)}")
+        self.strategy = strategy
+        self.spill_after = spill_after
+        self.store = {}  # key id -> [record, score total, count, first-seen sequence]
+        self.unique = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def normalize_key(value) -> str:
+        return str(value or '').strip().lower()
+
+    @staticmethod
+    def key_id(normalized: str) -> int:
+        return int.from_bytes(hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).digest(),
+                              'little', signed=True)
+
+    def add(self, user: Dict) -> bool:
+        """Merges one record; returns True when it is the first record for its user."""
+        normalized = self.normalize_key(user.get('user'))
+        if not normalized:
+            return False
+        key = self.key_id(normalized)
+        score = user.get('expScore') or 0
+        entry = self.store.get(key)
+        if entry is None:
+            self.store[key] = [user, score, 1, self.unique]
+            self.unique += 1
+            if self.spill_after and isinstance(self.store, dict) and self.unique > self.spill_after:
+                self._spill()
+            return True
+        self.duplicates += 1
+        record, total, count, seq = entry
+        kept_score = record.get('expScore') or 0
+        if (self.strategy == 'last'
+                or (self.strategy == 'max' and score > kept_score)
+                or (self.strategy == 'min' and score < kept_score)):
+            record = user
+        self.store[key] = [record, total + score, count + 1, seq]
+        return False
+
+    def _spill(self):
+        logger.info(f"Spilling {self.unique:,} merged users to disk")
+        spilled = SpillStore()
+        for key, entry in self.store.items():
+            spilled[key] = entry
+        self.store = spilled
+
+    def __len__(self):
+        return self.unique
+
+    def __iter__(self):
+        for record, total, count, _ in self.store.values():
+            if self.strategy == 'mean' and count > 1:
+                record = dict(record, expScore=round(total / count))
+            yield record
+
+class BoundedWorstHeap:
+    """Keeps the `size` users with the lowest score; a user's score is the lowest seen for them."""
+    _sequence = itertools.count()
+
+    def __init__(self, size: int):
+        self.size = size
+        self.heap = []      # (-score, sequence, key): the root is the highest kept score
+        self.members = {}   # key -> (score, record)
+
+    def _pop_stale(self):
+        # Entries left behind when a member's score was lowered are dropped lazily
+        while self.heap and self.members.get(self.heap[0][2], (None,))[0] != -self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def full(self) -> bool:
+        return len(self.members) >= self.size
+
+    def threshold(self) -> float:
+        if not self.full():
+            return float('inf')
+        self._pop_stale()
+        return -self.heap[0][0]
+
+    def offer(self, key, score, record) -> bool:
+        """Returns True when the user enters the heap."""
+        current = self.members.get(key)
+        if current is not None:
+            if score < current[0]:
+                self.members[key] = (score, record)
+                heapq.heappush(self.heap, (-score, next(self._sequence), key))
+                if len(self.heap) > 2 * self.size:
+                    self.heap = [(-s, next(self._sequence), k) for k, (s, _) in self.members.items()]
+                    heapq.heapify(self.heap)
+            return False
+        if self.full():
+            if score >= self.threshold():
+                return False
+            _, _, evicted = heapq.heappop(self.heap)
+            del self.members[evicted]
+        self.members[key] = (score, record)
+        heapq.heappush(self.heap, (-score, next(self._sequence), key))
+        return True
+
+    def __len__(self):
+        return len(self.members)
+
+    def records(self) -> List[Dict]:
+        """Kept records, worst first, each carrying the lowest score seen for that user."""
+        return [dict(record, expScore=score) for score, record in sorted(self.members.values(), key=lambda m: m[0])]
+
+class TopNCollector:
+    """Worst-N users overall, per group and per location, plus running per-group score stats.
+
+    Memory depends on N and the number of groups/locations, not on tenant size.
+    Group stats count every record seen, so a user active in several windows
+    counts once per window. Early stopping waits until no record can enter any
+    heap (overall, per group or per location), but group averages and groups not
+    yet seen still need the rest of the window, so once a window has stopped
+    early the report leaves out the group and location sections.
+    """
+    def __init__(self, n_users: int = TOP_N_USERS, n_groups: int = TOP_N_GROUPS, n_per_key: int = TOP_N_PER_KEY,
+                 early_stop: bool = TOP_N_EARLY_STOP):
+        self.n_groups = n_groups
+        self.n_per_key = n_per_key
+        self.early_stop = early_stop
+        self.overall = BoundedWorstHeap(n_users)
+        self.by_group = {}
+        self.by_location = {}
+        self.group_stats = {}  # group -> [records, score total, min score]
+        self.seen = 0
+        self.early_stops = 0
+        # Highest score any heap would still take; refreshed by the consuming thread after each page
+        self.cutoff = float('inf')
+
+    def add(self, user: Dict) -> bool:
+        normalized = RecordMerger.normalize_key(user.get('user'))
+        if not normalized:
+            return False
+        self.seen += 1
+        key = RecordMerger.key_id(normalized)
+        score = user['expScore']
+        entered = self.overall.offer(key, score, user)
+        for group in user.get('userGroups') or ['No Group']:
+            heap = self.by_group.get(group)
+            if heap is None:
+                heap = self.by_group[group] = BoundedWorstHeap(self.n_per_key)
+            heap.offer(key, score, user)
+            stats = self.group_stats.get(group)
+            if stats is None:
+                self.group_stats[group] = [1, score, score]
+            else:
+                stats[0] += 1
+                stats[1] += score
+                stats[2] = min(stats[2], score)
+        location = user.get('location') or 'Unknown'
+        heap = self.by_location.get(location)
+        if heap is None:
+            heap = self.by_location[location] = BoundedWorstHeap(self.n_per_key)
+        heap.offer(key, score, user)
+        return entered
+
+    def refresh_cutoff(self):
+        # A heap that isn't full takes anything, so one open heap keeps the cutoff at inf
+        heaps = itertools.chain((self.overall,), self.by_group.values(), self.by_location.values())
+        self.cutoff = max(heap.threshold() for heap in heaps)
+
+    def can_stop(self, score) -> bool:
+        """With ascending pages, nothing at or above this score can enter any of the heaps."""
+        return score is not None and score >= self.cutoff
+
+    def worst_groups(self) -> pd.DataFrame:
+        rows = [{'Group Short': group.split('/')[-1], 'Records': count, 'Avg Score': round(total / count, 2),
+                 'Min Score': low, 'Group': group} for group, (count, total, low) in self.group_stats.items()]
+        df = pd.DataFrame(rows, columns=['Group Short', 'Records', 'Avg Score', 'Min Score', 'Group'])
+        return df.sort_values(['Avg Score', 'Min Score']).head(self.n_groups) if not df.empty else df
+
+    def worst_by_key(self, heaps: Dict[str, BoundedWorstHeap], label: str, keys=None) -> pd.DataFrame:
+        rows = []
+        for key in keys if keys is not None else sorted(heaps):
+            for rank, record in enumerate(heaps[key].records(), 1):
+                rows.append({label: key, 'Rank': rank, 'User Email': record.get('user', ''),
+                             'Experience Score': record['expScore']})
+        return pd.DataFrame(rows, columns=[label, 'Rank', 'User Email', 'Experience Score'])
+
+class PageArchive:
+    """Raw getentities responses on disk, for recording a run and replaying it offline.
+
+    Each page is a gzip JSON file named after its request (window start/end,
+    sort order, offset, limit), so the file name is the index. meta.json
+    records the run's time range, sort order, page size and fetch plan, so a
+    replay requests exactly the recorded pages whatever CONCURRENCY or
+    ADAPTIVE_WINDOWS are set to. A worst-N recording with early stop only holds
+    the pages that run needed, so it replays only in the same worst-N setup.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.join(path, 'pages'), exist_ok=True)
+
+    def _page_path(self, starttime, endtime, sort_order, offset, limit) -> str:
+        return os.path.join(self.path, 'pages', f"{starttime}_{endtime}_{sort_order}_{offset}_{limit}.json.gz")
+
+    def save(self, starttime, endtime, sort_order, offset, limit, data: Dict):
+        path = self._page_path(starttime, endtime, sort_order, offset, limit)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def load(self, starttime, endtime, sort_order, offset, limit) -> Dict:
+        path = self._page_path(starttime, endtime, sort_order, offset, limit)
+        if not os.path.exists(path):
+            raise LookupError(f"No recorded page for window {starttime}-{endtime} ({sort_order}), "
+                              f"offset={offset}, limit={limit} in {self.path}")
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_meta(self, **meta):
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, recorded_at=datetime.now(timezone.utc).isoformat()), f, indent=2, default=str)
+
+    def read_meta(self) -> Dict:
+        with open(os.path.join(self.path, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def plan_to_json(plan: Optional[Dict]) -> Optional[Dict]:
+        if plan is None:
+            return None
+        return dict(plan, windows=[dict(w, start=w['start'].isoformat(), end=w['end'].isoformat())
+                                   for w in plan['windows']])
+
+    @staticmethod
+    def plan_from_json(plan: Optional[Dict]) -> Optional[Dict]:
+        if plan is None:
+            return None
+        return dict(plan, windows=[dict(w, start=datetime.fromisoformat(w['start']), end=datetime.fromisoformat(w['end']))
+                                   for w in plan['windows']])
+
+    @staticmethod
+    def replay_mismatch(meta: Dict, limit: int, record_filter: RecordFilter) -> Optional[str]:
+        """Why the current settings would ask for pages the recording doesn't have, if they would."""
+        if meta.get('dry_run') and not DRY_RUN:
+            return "recorded as a dry run, so it only holds the planning probes; replay it with DRY_RUN"
+        if meta.get('limit') != limit:
+            return f"recorded with {meta.get('limit')} records per page, this client requests {limit}"
+        if meta.get('early_stop'):
+            if not (TOP_N_MODE and TOP_N_EARLY_STOP):
+                return "recorded in worst-N mode with early stop; set TOP_N_MODE and TOP_N_EARLY_STOP to replay it"
+            if TOP_N_USERS > meta['top_n_users'] or TOP_N_PER_KEY > meta['top_n_per_key']:
+                return (f"recorded for the worst {meta['top_n_users']} users and {meta['top_n_per_key']} per "
+                        f"group/location; TOP_N_USERS and TOP_N_PER_KEY can't exceed that")
+            if record_filter.describe() != meta['filter']:
+                return f"recorded with filter '{meta['filter']}'; early stop needs the same filter to replay"
+        return None
+
 class NetskopeAPIClient:
     def __init__(self, api_url: str, api_token: str):
         self.api_url = api_url
@@ -44,7 +629,20 @@ class NetskopeAPIClient:
         }
         self.session = requests.Session()
         self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(10, CONCURRENCY))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.MAX_LIMIT = 100
+        self.WINDOW = timedelta(hours=48)  # API maximum per request
+        self.MIN_WINDOW = timedelta(hours=1)
+        self.PAGE_DELAY = 0.2  # small delay between pages for rate limits
+        self.recorder: Optional[PageArchive] = None
+        self.replay: Optional[PageArchive] = None
+
+    def replay_from(self, archive: PageArchive):
+        # Pages come from disk, so there is no rate limit to respect
+        self.replay = archive
+        self.PAGE_DELAY = 0
 
     def get_users(self, limit=100, offset=0, start_time=None, end_time=None, sort_order="desc"):
         limit = min(limit, self.MAX_LIMIT)
@@ -58,87 +656,291 @@ class NetskopeAPIClient:
         if start_time and end_time:
             body["starttime"] = int(start_time.timestamp())
             body["endtime"] = int(end_time.timestamp())
-        logger.debug(f"API Request to {self.api_url} with params={params} and body={json.dumps(body)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API Request to %s with params=%s and body=%s", self.api_url, params, json.dumps(body))
+        page_key = (body.get("starttime"), body.get("endtime"), sort_order, offset, limit)
+        if self.replay is not None:
+            with profiler.timer('decode'):
+                return self.replay.load(*page_key)
         try:
-            response = self.session.post(self.api_url, params=params, json=body)
+            with profiler.timer('network'):
+                response = self.session.post(self.api_url, params=params, json=body)
             if response.status_code == 429:
                 retry_after = int(response.headers.get('Retry-After', 60))
                 logger.warning(f"Rate limited. Waiting {retry_after} seconds...")
-                print(f"\n{Fore.YELLOW}⚠️  Rate limited. Waiting {retry_after} seconds...{Style.RESET_ALL}")
+                if not QUIET_MODE:
+                    print(f"\n{Fore.YELLOW}⚠️  Rate limited. Waiting {retry_after} seconds...{Style.RESET_ALL}")
                 time.sleep(retry_after)
-                response = self.session.post(self.api_url, params=params, json=body)
+                with profiler.timer('network'):
+                    response = self.session.post(self.api_url, params=params, json=body)
             response.raise_for_status()
-            return response.json()
+            with profiler.timer('decode'):
+                data = response.json()
+            if self.recorder is not None:
+                self.recorder.save(*page_key, data)
+            return data
         except requests.exceptions.RequestException as e:
             logger.error(f"API request failed: {e}")
             raise
 
-    def get_all_users_chunked(self, start_time, end_time, sort_order="desc"):
-        all_users = []
-        unique_users = {}
-        duplicate_count = 0
-        total_api_calls = 0
-        delta = timedelta(hours=48)
+    def time_windows(self, start_time, end_time):
         chunk_start = start_time
-        total_chunks = int((end_time - start_time) / delta) + 1
-        pbar = tqdm(desc="Time windows", total=total_chunks, unit="window", colour='green')
         while chunk_start < end_time:
-            chunk_end = min(chunk_start + delta, end_time)
-            print(f"{Fore.MAGENTA}\n🔎 Fetching chunk: {chunk_start} to {chunk_end}{Style.RESET_ALL}")
-            offset = 0
-            batch_count = 0
-            while True:
-                batch_count += 1
-                total_api_calls += 1
-                logger.info(f"Fetching batch {batch_count} in chunk ({chunk_start} - {chunk_end}), offset={offset}")
-                batch = self.get_users(
-                    limit=self.MAX_LIMIT,
-                    offset=offset,
-                    start_time=chunk_start,
-                    end_time=chunk_end,
-                    sort_order=sort_order
-                )
-                users = batch.get('users', [])
-                if not users:
-                    break
-                batch_new = 0
-                for user in users:
-                    exp_score = user.get('expScore', 0)
-                    if exp_score is None or exp_score <= 0:
-                        continue
-                    user_email = user.get('user', '').strip().lower()
-                    if user_email:
-                        if user_email not in unique_users:
-                            unique_users[user_email] = user
-                            all_users.append(user)
-                            batch_new += 1
-                        else:
-                            duplicate_count += 1
-                print(
-                    f"{Fore.BLUE}[Chunk: {chunk_start.strftime('%Y-%m-%d %H:%M')} Batch {batch_count}] "
-                    f"Unique users so far: {len(unique_users):,} (+{batch_new}), Duplicates: {duplicate_count:,}{Style.RESET_ALL}"
-                )
-                if len(users) < self.MAX_LIMIT:
-                    break
-                offset += self.MAX_LIMIT
-                time.sleep(0.2)  # small delay for rate limits
+            chunk_end = min(chunk_start + self.WINDOW, end_time)
+            yield chunk_start, chunk_end
             chunk_start = chunk_end
-            pbar.update(1)
+
+    def window_pages(self, chunk_start, chunk_end, sort_order="desc", stop=None):
+        """Yields each page of users for one window, including the final short or empty page.
+
+        stop(users) is checked after each full page; returning True ends the window early.
+        """
+        offset = 0
+        batch_count = 0
+        while True:
+            batch_count += 1
+            logger.info("Fetching batch %d in chunk (%s - %s), offset=%d", batch_count, chunk_start, chunk_end, offset)
+            batch = self.get_users(
+                limit=self.MAX_LIMIT,
+                offset=offset,
+                start_time=chunk_start,
+                end_time=chunk_end,
+                sort_order=sort_order
+            )
+            users = batch.get('users', [])
+            yield users
+            if len(users) < self.MAX_LIMIT:
+                break
+            if stop is not None and stop(users):
+                break
+            offset += self.MAX_LIMIT
+            time.sleep(self.PAGE_DELAY)
+
+    def _prefetch_windows(self, windows, sort_order, stop, concurrency):
+        # Workers page through whole windows; results are yielded in window order so the
+        # first-seen record per user is the same as in a serial run. Only one window beyond
+        # the workers is queued, so a slow window can't pile every later window up in memory.
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            pending = deque()
+            for chunk_start, chunk_end in windows:
+                pending.append(executor.submit(
+                    lambda s, e: list(self.window_pages(s, e, sort_order, stop)), chunk_start, chunk_end))
+                if len(pending) > concurrency:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def get_all_users_chunked(self, start_time, end_time, sort_order="desc", plan=None, concurrency=1,
+                              timeseries=None, merger=None, record_filter=None, topn=None):
+        # Records go to the top-N heaps instead of the merger when a TopNCollector is given
+        sink = topn if topn is not None else (merger if merger is not None else RecordMerger())
+        record_filter = record_filter if record_filter is not None else RecordFilter()
+        matches, project = record_filter.matches, record_filter.project
+        stop = None
+        if topn is not None and topn.early_stop and sort_order == "asc" and concurrency <= 1:
+            # Serial only: the cutoff is refreshed after each page is consumed, which parallel
+            # workers run ahead of
+            def stop(users):
+                if topn.can_stop(users[-1].get('expScore')):
+                    topn.early_stops += 1
+                    return True
+                return False
+        total_api_calls = 0
+        if plan:
+            windows = [(w['start'], w['end']) for w in plan['windows']]
+            pbar = tqdm(desc="API calls", total=plan['api_calls'], unit="call", colour='green',
+                        mininterval=PROGRESS_REFRESH_SECONDS, disable=QUIET_MODE)
+        else:
+            windows = list(self.time_windows(start_time, end_time))
+            pbar = tqdm(desc="Time windows", total=len(windows), unit="window", colour='green',
+                        mininterval=PROGRESS_REFRESH_SECONDS, disable=QUIET_MODE)
+        progress = ThrottledPrinter()
+        if concurrency > 1 and len(windows) > 1:
+            window_results = self._prefetch_windows(windows, sort_order, stop, concurrency)
+        else:
+            window_results = (self.window_pages(w[0], w[1], sort_order, stop) for w in windows)
+        try:
+            for (chunk_start, chunk_end), pages in zip(windows, window_results):
+                progress(f"{Fore.MAGENTA}\n🔎 Fetching chunk: {chunk_start} to {chunk_end}{Style.RESET_ALL}", force=True)
+                for batch_count, users in enumerate(pages, 1):
+                    total_api_calls += 1
+                    if plan:
+                        pbar.update(1)
+                    if not users:
+                        break
+                    batch_new = 0
+                    with profiler.timer('filter+dedup'):
+                        for user in users:
+                            if not matches(user):
+                                continue
+                            user = project(user)
+                            if timeseries is not None:
+                                # Every window's record counts here, including ones dedup drops below
+                                timeseries.add(chunk_start, chunk_end, user)
+                            if sink.add(user):
+                                batch_new += 1
+                    if topn is not None:
+                        topn.refresh_cutoff()
+                        progress(
+                            f"{Fore.BLUE}[Chunk: {chunk_start.strftime('%Y-%m-%d %H:%M')} Batch {batch_count}] "
+                            f"Records scanned: {topn.seen:,}, worst-{topn.overall.size} cutoff: "
+                            f"{topn.cutoff:g}{Style.RESET_ALL}"
+                        )
+                    else:
+                        progress(
+                            f"{Fore.BLUE}[Chunk: {chunk_start.strftime('%Y-%m-%d %H:%M')} Batch {batch_count}] "
+                            f"Unique users so far: {len(sink):,} (+{batch_new}), Duplicates: {sink.duplicates:,}{Style.RESET_ALL}"
+                        )
+                if not plan:
+                    pbar.update(1)
+        finally:
+            window_results.close()
         pbar.close()
-        print(f"{Fore.GREEN}✓ Total unique users: {len(unique_users):,}{Style.RESET_ALL}")
-        print(f"{Fore.YELLOW}📊 Total duplicates skipped: {duplicate_count:,}{Style.RESET_ALL}")
+        if topn is not None:
+            print(f"{Fore.GREEN}✓ Records scanned: {topn.seen:,}, windows stopped early: {topn.early_stops}{Style.RESET_ALL}")
+        else:
+            print(f"{Fore.GREEN}✓ Total unique users: {len(sink):,}{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}📊 Total duplicates merged ({sink.strategy}): {sink.duplicates:,}{Style.RESET_ALL}")
         print(f"{Fore.CYAN}📊 Total API calls made: {total_api_calls}{Style.RESET_ALL}")
-        return list(unique_users.values())
+        return sink
+
+class FetchPlanner:
+    """Sizes a pull up front by probing time windows with limit=1 requests.
+
+    With adaptive sizing, windows whose page count exceeds an even share of the
+    work per worker are split in half (down to the client's MIN_WINDOW), and
+    neighbouring cold windows are merged back up to the API maximum. A merged
+    window returns each user once instead of once per window, so it saves calls
+    and duplicate records. A split is kept only when the halves hold mostly
+    different users, and the adaptive layout is dropped if its projected
+    makespan is no better than the fixed windows'.
+    """
+    MEMORY_FACTOR = 6.0  # in-memory size of a parsed record relative to its JSON size
+    XLSX_FACTOR = 0.4    # compressed xlsx bytes per JSON byte of a record
+    SPLIT_OVERLAP = 1.1  # keep a split only if the halves' pages stay within this factor of the parent's
+
+    def __init__(self, client: NetskopeAPIClient):
+        self.client = client
+        self.probe_calls = 0
+        self.latencies = []
+        self.record_sizes = []
+
+    def _probe(self, start_time, end_time, sort_order) -> Dict:
+        limit = self.client.MAX_LIMIT
+        call_start = time.time()
+        batch = self.client.get_users(limit=1, offset=0, start_time=start_time,
+                                      end_time=end_time, sort_order=sort_order)
+        self.latencies.append(time.time() - call_start)
+        self.probe_calls += 1
+        total = int(batch.get('totalUsersCount') or 0)
+        self.record_sizes.extend(len(json.dumps(user)) for user in batch.get('users', []))
+        # window_pages stops on a short page, so a full last page costs one extra call
+        return {'start': start_time, 'end': end_time, 'total_users': total,
+                'pages': -(-total // limit), 'api_calls': total // limit + 1}
+
+    def _split_hot(self, window: Dict, target_pages: int, sort_order) -> List[Dict]:
+        span = window['end'] - window['start']
+        if window['pages'] <= target_pages or span < 2 * self.client.MIN_WINDOW:
+            return [window]
+        middle = window['start'] + span / 2
+        halves = [self._probe(window['start'], middle, sort_order), self._probe(middle, window['end'], sort_order)]
+        if sum(half['pages'] for half in halves) > window['pages'] * self.SPLIT_OVERLAP:
+            # Most of the window's users are active in both halves; splitting would only fetch them twice
+            return [window]
+        return [piece for half in halves for piece in self._split_hot(half, target_pages, sort_order)]
+
+    def _merge_cold(self, windows: List[Dict], target_pages: int, sort_order) -> List[Dict]:
+        merged = []
+        for window in windows:
+            if merged:
+                last = merged[-1]
+                if (window['end'] - last['start'] <= self.client.WINDOW
+                        and last['pages'] + window['pages'] <= target_pages):
+                    merged[-1] = {'start': last['start'], 'end': window['end'], 'merged': True}
+                    merged[-1]['pages'] = last['pages'] + window['pages']  # upper bound until re-probed
+                    continue
+            merged.append(window)
+        # Users active in both halves are only counted once, so re-probe for exact sizes
+        return [self._probe(w['start'], w['end'], sort_order) if w.get('merged') else w for w in merged]
+
+    def _makespan(self, windows: List[Dict], avg_latency: float, concurrency: int) -> float:
+        # Longest-first assignment of whole windows to the least loaded worker
+        loads = [0.0] * concurrency
+        costs = sorted((w['api_calls'] * avg_latency + (w['api_calls'] - 1) * self.client.PAGE_DELAY
+                        for w in windows), reverse=True)
+        for cost in costs:
+            loads[loads.index(min(loads))] += cost
+        return max(loads) if loads else 0.0
+
+    def plan(self, start_time, end_time, sort_order="desc", concurrency=1, adaptive=False) -> Dict:
+        concurrency = max(1, concurrency)
+        windows = [self._probe(s, e, sort_order) for s, e in self.client.time_windows(start_time, end_time)]
+        if adaptive:
+            fixed = windows
+            total_pages = sum(w['pages'] for w in windows)
+            target_pages = max(1, -(-total_pages // concurrency)) if concurrency > 1 else max(total_pages, 1)
+            windows = [piece for w in windows for piece in self._split_hot(w, target_pages, sort_order)]
+            windows = self._merge_cold(windows, target_pages, sort_order)
+            avg_latency = sum(self.latencies) / len(self.latencies)
+            if self._makespan(windows, avg_latency, concurrency) >= self._makespan(fixed, avg_latency, concurrency):
+                windows = fixed
+        api_calls = sum(w['api_calls'] for w in windows)
+        records = sum(w['total_users'] for w in windows)
+        avg_latency = sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+        avg_record = sum(self.record_sizes) / len(self.record_sizes) if self.record_sizes else 0.0
+        return {
+            'windows': windows,
+            'probe_calls': self.probe_calls,
+            'api_calls': api_calls,
+            'records': records,
+            'avg_latency': avg_latency,
+            'concurrency': concurrency,
+            'est_seconds': self._makespan(windows, avg_latency, concurrency),
+            'est_memory_bytes': int(records * avg_record * FetchPlanner.MEMORY_FACTOR),
+            'est_output_bytes': int(records * avg_record * FetchPlanner.XLSX_FACTOR),
+        }
+
+    @staticmethod
+    def _format_bytes(size: float) -> str:
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024:
+                return f"{size:.1f} {unit}"
+            size /= 1024
+        return f"{size:.1f} TB"
+
+    @staticmethod
+    def print_plan(plan: Dict):
+        print(f"\n{Fore.CYAN}🧭 Fetch Plan:{Style.RESET_ALL}")
+        for w in plan['windows']:
+            print(f"   • {w['start'].strftime('%Y-%m-%d %H:%M')} → {w['end'].strftime('%Y-%m-%d %H:%M')}: "
+                  f"{w['total_users']:,} records, {w['pages']:,} pages, {w['api_calls']:,} calls")
+        print(f"   • Probe calls used: {plan['probe_calls']:,}")
+        print(f"   • Expected API calls: {plan['api_calls']:,}")
+        print(f"   • Records across windows (before dedup): {plan['records']:,}")
+        print(f"   • Measured latency: {plan['avg_latency']:.2f}s per call, concurrency {plan['concurrency']}")
+        print(f"   • Projected runtime: {timedelta(seconds=int(plan['est_seconds']))}")
+        print(f"   • Estimated memory: {FetchPlanner._format_bytes(plan['est_memory_bytes'])}")
+        print(f"   • Estimated output size: {FetchPlanner._format_bytes(plan['est_output_bytes'])}")
 
 class UserDataProcessor:
+    # Report columns built from raw fields that RecordFilter projection may drop
+    SOURCE_FIELDS = {
+        'devices': ['Device Count', 'Device Names', 'Device Classifications'],
+        'applicationsCount': ['Applications Count'],
+        'applications': ['Applications'],
+        'npaHosts': ['NPA Hosts'],
+    }
+
     @staticmethod
-    def process_users(users: List[Dict]) -> pd.DataFrame:
-        print(f"\n{Fore.CYAN}🔄 Processing user data (expScore > 0)...{Style.RESET_ALL}")
+    def process_users(users: Iterable[Dict], fields: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        print(f"\n{Fore.CYAN}🔄 Processing user data...{Style.RESET_ALL}")
         processed_data = []
+        # Records arrive already filtered (expScore > 0 and any configured criteria) by RecordFilter
         for user in users:
             exp_score = user.get('expScore', 0)
-            if exp_score is None or exp_score <= 0:
-                continue
             devices = user.get('devices', [])
             device_names = ', '.join([d.get('deviceName', '') for d in devices])
             device_classifications = ', '.join([d.get('deviceClassification', '') for d in devices])
@@ -161,6 +963,11 @@ class UserDataProcessor:
             }
             processed_data.append(processed_user)
         df = pd.DataFrame(processed_data)
+        if fields is not None:
+            # Leave out columns whose source was projected away rather than report empty values
+            kept = set(fields)
+            df = df.drop(columns=[column for field, columns in UserDataProcessor.SOURCE_FIELDS.items()
+                                  if field not in kept for column in columns], errors='ignore')
         print(f"{Fore.GREEN}✓ Processed {len(df):,} user records{Style.RESET_ALL}")
         return df
 
@@ -193,38 +1000,207 @@ class UserDataProcessor:
         print(f"{Fore.GREEN}✓ Created aggregations for {len(group_agg)} groups{Style.RESET_ALL}")
         return group_agg
 
+class TimeSeriesAggregator:
+    """Per-window score stats by group and location, accumulated while pages are ingested."""
+    COLUMNS = ['Window Start', 'Window End', 'Dimension', 'Key', 'Users', 'Avg Score', 'Min Score', 'Max Score']
+
+    def __init__(self):
+        # (window start, window end, dimension, key) -> [count, total, min, max]
+        self.stats = {}
+
+    def _update(self, key, score):
+        entry = self.stats.get(key)
+        if entry is None:
+            self.stats[key] = [1, score, score, score]
+        else:
+            entry[0] += 1
+            entry[1] += score
+            entry[2] = min(entry[2], score)
+            entry[3] = max(entry[3], score)
+
+    def add(self, window_start, window_end, user: Dict):
+        score = user.get('expScore')
+        self._update((window_start, window_end, 'Overall', 'All Users'), score)
+        for group in user.get('userGroups') or ['No Group']:
+            self._update((window_start, window_end, 'Group', group), score)
+        self._update((window_start, window_end, 'Location', user.get('location') or 'Unknown'), score)
+
+    def to_frame(self) -> pd.DataFrame:
+        rows = [(start, end, dimension, key, count, round(total / count, 2), low, high)
+                for (start, end, dimension, key), (count, total, low, high) in self.stats.items()]
+        return pd.DataFrame(rows, columns=self.COLUMNS).sort_values(['Window Start', 'Dimension', 'Key'])
+
+    @staticmethod
+    def pivot(trend_df: pd.DataFrame, top_n: int = TREND_TOP_GROUPS) -> pd.DataFrame:
+        """Average score per window for all users and the top_n largest groups, one column each."""
+        groups = trend_df[trend_df['Dimension'] == 'Group']
+        top = groups.groupby('Key')['Users'].sum().nlargest(top_n).index
+        selected = pd.concat([trend_df[trend_df['Dimension'] == 'Overall'], groups[groups['Key'].isin(top)]])
+        table = selected.pivot_table(index='Window Start', columns='Key', values='Avg Score', sort=False)
+        short = {key: key.split('/')[-1] for key in table.columns}
+        if len(set(short.values())) == len(short):
+            table = table.rename(columns=short)
+        table = table.sort_index().reset_index()
+        table['Window Start'] = table['Window Start'].map(lambda t: t.strftime('%Y-%m-%d %H:%M'))
+        return table
+
+    @staticmethod
+    def write_columnar(trend_df: pd.DataFrame, path: str) -> str:
+        try:
+            trend_df.to_parquet(path, index=False)
+            return path
+        except ImportError:
+            csv_path = os.path.splitext(path)[0] + '.csv'
+            logger.warning(f"Parquet engine not installed, writing trends to {csv_path}")
+            trend_df.to_csv(csv_path, index=False)
+            return csv_path
+
+class RunSnapshot:
+    """Compact per-run state (score per user, group aggregates) used to diff consecutive runs.
+
+    Only runs with the same scope (range length and filter) are comparable, so
+    each scope keeps its own snapshot file.
+    """
+    VERSION = 2
+
+    @staticmethod
+    def scope(start_time, end_time, record_filter: Optional[RecordFilter] = None) -> Dict:
+        record_filter = record_filter if record_filter is not None else RecordFilter()
+        return {'range_hours': round((end_time - start_time).total_seconds() / 3600), 'filter': record_filter.describe()}
+
+    @staticmethod
+    def scope_path(path: str, scope: Dict) -> str:
+        digest = hashlib.blake2b(json.dumps(scope, sort_keys=True).encode('utf-8'), digest_size=4).hexdigest()
+        root, ext = (path[:-len('.json.gz')], '.json.gz') if path.endswith('.json.gz') else os.path.splitext(path)
+        return f"{root}_{digest}{ext}"
+
+    @staticmethod
+    def build(df: pd.DataFrame, group_df: pd.DataFrame, start_time, end_time,
+              record_filter: Optional[RecordFilter] = None) -> Dict:
+        users = {}
+        for email, score, groups in zip(df['User Email'], df['Experience Score'], df['User Groups']):
+            key = str(email).strip().lower()
+            if key:
+                users[key] = [float(score), groups]
+        groups = {group: [int(count), float(avg)] for group, count, avg
+                  in zip(group_df['Group'], group_df['User Count'], group_df['Avg Score'])}
+        return {'version': RunSnapshot.VERSION, 'created': datetime.now(timezone.utc).isoformat(),
+                'start': start_time.isoformat(), 'end': end_time.isoformat(),
+                'scope': RunSnapshot.scope(start_time, end_time, record_filter),
+                'users': users, 'groups': groups}
+
+    @staticmethod
+    def load(path: str) -> Optional[Dict]:
+        if not os.path.exists(path):
+            return None
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+            return None
+        if snapshot.get('version') != RunSnapshot.VERSION:
+            logger.warning(f"Ignoring snapshot {path} with version {snapshot.get('version')}")
+            return None
+        return snapshot
+
+    @staticmethod
+    def save(snapshot: Dict, path: str):
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def diff(previous: Dict, current: Dict, min_change: float = DIFF_MIN_SCORE_CHANGE) -> Dict[str, pd.DataFrame]:
+        # Hash join on the user key: one pass over each side
+        prev_users, curr_users = previous['users'], current['users']
+        changed, new = [], []
+        for email, (score, groups) in curr_users.items():
+            old = prev_users.get(email)
+            if old is None:
+                new.append({'User Email': email, 'Experience Score': score, 'User Groups': groups})
+            elif abs(score - old[0]) >= min_change:
+                changed.append({'User Email': email, 'Previous Score': old[0], 'Current Score': score,
+                                'Change': round(score - old[0], 2), 'User Groups': groups})
+        gone = [{'User Email': email, 'Previous Score': score, 'User Groups': groups}
+                for email, (score, groups) in prev_users.items() if email not in curr_users]
+
+        prev_groups, curr_groups = previous['groups'], current['groups']
+        movements = []
+        for group in sorted(prev_groups.keys() | curr_groups.keys()):
+            old_count, old_avg = prev_groups.get(group, [0, None])
+            new_count, new_avg = curr_groups.get(group, [0, None])
+            change = round(new_avg - old_avg, 2) if old_avg is not None and new_avg is not None else None
+            movements.append({'Group Short': group.split('/')[-1], 'Previous Avg': old_avg, 'Current Avg': new_avg,
+                              'Change': change, 'Previous Users': old_count, 'Current Users': new_count,
+                              'Group': group})
+
+        def frame(rows, columns, sort_by=None):
+            df = pd.DataFrame(rows, columns=columns)
+            return df.sort_values(sort_by, na_position='last') if sort_by and not df.empty else df
+
+        return {
+            'changed': frame(changed, ['User Email', 'Previous Score', 'Current Score', 'Change', 'User Groups'], 'Change'),
+            'new': frame(new, ['User Email', 'Experience Score', 'User Groups'], 'Experience Score'),
+            'gone': frame(gone, ['User Email', 'Previous Score', 'User Groups'], 'Previous Score'),
+            'groups': frame(movements, ['Group Short', 'Previous Avg', 'Current Avg', 'Change',
+                                        'Previous Users', 'Current Users', 'Group'], 'Change'),
+        }
+
+    @staticmethod
+    def print_diff(diff: Dict[str, pd.DataFrame], previous: Dict):
+        changed = diff['changed']
+        worse = int((changed['Change'] < 0).sum()) if not changed.empty else 0
+        print(f"\n{Fore.CYAN}🔀 Changes since run of {previous.get('created', 'unknown')}:{Style.RESET_ALL}")
+        print(f"   • Users with score change ≥ {DIFF_MIN_SCORE_CHANGE}: {len(changed):,} ({worse:,} worse)")
+        print(f"   • New users: {len(diff['new']):,}")
+        print(f"   • Disappeared users: {len(diff['gone']):,}")
+        dropped = diff['groups'].dropna(subset=['Change'])
+        dropped = dropped[dropped['Change'] < 0].head(5)
+        if not dropped.empty:
+            print("   • Biggest group drops:")
+            for group, old_avg, new_avg in zip(dropped['Group Short'], dropped['Previous Avg'], dropped['Current Avg']):
+                print(f"       {group}: {old_avg:.1f} → {new_avg:.1f}")
+
 class ExcelReportGenerator:
+    WIDTH_SAMPLE_ROWS = 5000
+    MAX_COLUMN_WIDTH = 50
+
     @staticmethod
-    def create_report(df, group_df, output_filename):
+    def _register_styles(wb):
+        # Named styles are registered once per workbook; cells then only carry a style reference
+        for name, color in (("user_header", "366092"), ("group_header", "4472C4")):
+            wb.add_named_style(NamedStyle(
+                name=name,
+                font=Font(bold=True, color="FFFFFF"),
+                fill=PatternFill(start_color=color, end_color=color, fill_type="solid"),
+                alignment=Alignment(horizontal="center", vertical="center")))
+
+    @staticmethod
+    def _write_sheet(worksheet, df, header_style):
+        worksheet.append(list(df.columns))
+        for row in df.itertuples(index=False):
+            worksheet.append(row)
+        for cell in worksheet[1]:
+            cell.style = header_style
+        ExcelReportGenerator._adjust_column_widths(worksheet, df)
+
+    @staticmethod
+    def create_report(df, group_df, output_filename, trend_df=None):
         print("\n📝 Creating Excel report...")
         wb = Workbook()
+        ExcelReportGenerator._register_styles(wb)
 
         # Sheet 1: User Activity Report
         ws_users = wb.active
         ws_users.title = "User Activity Report"
-        headers = list(df.columns)
-        for col_idx, header in enumerate(headers, 1):
-            cell = ws_users.cell(row=1, column=col_idx, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        for row_idx, row in enumerate(df.itertuples(index=False), 2):
-            for col_idx, value in enumerate(row, 1):
-                ws_users.cell(row=row_idx, column=col_idx, value=value)
-        ExcelReportGenerator._adjust_column_widths(ws_users)
+        ExcelReportGenerator._write_sheet(ws_users, df, "user_header")
 
         # Sheet 2: Group Summary
         group_display_cols = ['Group Short', 'User Count', 'Avg Score', 'Min Score', 'Max Score']
         ws_groups = wb.create_sheet("Group Summary")
-        for col_idx, header in enumerate(group_display_cols, 1):
-            cell = ws_groups.cell(row=1, column=col_idx, value=header)
-            cell.font = Font(bold=True, color="FFFFFF")
-            cell.fill = PatternFill(start_color="4472C4", end_color="4472C4", fill_type="solid")
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-        for row_idx, row in enumerate(group_df[group_display_cols].itertuples(index=False), 2):
-            for col_idx, value in enumerate(row, 1):
-                ws_groups.cell(row=row_idx, column=col_idx, value=value)
-        ExcelReportGenerator._adjust_column_widths(ws_groups)
+        ExcelReportGenerator._write_sheet(ws_groups, group_df[group_display_cols], "group_header")
 
         # Clean Bar Chart: Average Experience Score by Group
         if group_df.shape[0] > 0:
@@ -246,22 +1222,292 @@ class ExcelReportGenerator:
             chart.gapWidth = 100
             ws_groups.add_chart(chart, "H2")
 
+        # Sheet 3: Trends (average score per time window)
+        if trend_df is not None and not trend_df.empty:
+            trend_table = TimeSeriesAggregator.pivot(trend_df)
+            ws_trends = wb.create_sheet("Trends")
+            ExcelReportGenerator._write_sheet(ws_trends, trend_table, "group_header")
+            chart = LineChart()
+            chart.title = "Average Experience Score per Time Window"
+            chart.y_axis.title = "Average Experience Score"
+            chart.x_axis.title = "Window Start"
+            chart.style = 2
+            data = Reference(ws_trends, min_col=2, min_row=1, max_col=trend_table.shape[1],
+                             max_row=trend_table.shape[0] + 1)
+            cats = Reference(ws_trends, min_col=1, min_row=2, max_row=trend_table.shape[0] + 1)
+            chart.add_data(data, titles_from_data=True)
+            chart.set_categories(cats)
+            chart.width = 20
+            chart.height = 10
+            ws_trends.add_chart(chart, f"{get_column_letter(trend_table.shape[1] + 2)}2")
+
         wb.save(output_filename)
         print(f"✓ Report saved to: {output_filename}")
 
     @staticmethod
-    def _adjust_column_widths(worksheet):
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            worksheet.column_dimensions[column_letter].width = adjusted_width
+    def create_top_n_report(topn: TopNCollector, output_filename, fields=None):
+        print("\n📝 Creating worst-N report...")
+        wb = Workbook()
+        ExcelReportGenerator._register_styles(wb)
+        worst_users = UserDataProcessor.process_users(topn.overall.records(), fields)
+        if not worst_users.empty:
+            worst_users.insert(0, 'Rank', range(1, len(worst_users) + 1))
+        ws_users = wb.active
+        ws_users.title = f"Worst {topn.overall.size} Users"
+        ExcelReportGenerator._write_sheet(ws_users, worst_users, "user_header")
+        if topn.early_stops:
+            # Stopped windows never delivered their higher scores, so group averages would be too low
+            print(f"{Fore.YELLOW}ℹ️  {topn.early_stops} window(s) stopped early; group and location sheets "
+                  f"need a full fetch (TOP_N_EARLY_STOP = False){Style.RESET_ALL}")
+        else:
+            worst_groups = topn.worst_groups()
+            ExcelReportGenerator._write_sheet(wb.create_sheet(f"Worst {topn.n_groups} Groups"), worst_groups,
+                                              "group_header")
+            ExcelReportGenerator._write_sheet(wb.create_sheet("Worst Users by Group"),
+                                              topn.worst_by_key(topn.by_group, 'Group', list(worst_groups['Group'])),
+                                              "group_header")
+            ExcelReportGenerator._write_sheet(wb.create_sheet("Worst Users by Location"),
+                                              topn.worst_by_key(topn.by_location, 'Location'), "group_header")
+        wb.save(output_filename)
+        print(f"✓ Worst-N report saved to: {output_filename}")
+
+    @staticmethod
+    def create_diff_report(diff, output_filename):
+        print("\n📝 Creating diff report...")
+        wb = Workbook()
+        ExcelReportGenerator._register_styles(wb)
+        ws_changed = wb.active
+        ws_changed.title = "Changed Users"
+        ExcelReportGenerator._write_sheet(ws_changed, diff['changed'], "user_header")
+        ExcelReportGenerator._write_sheet(wb.create_sheet("Group Movements"), diff['groups'], "group_header")
+        ExcelReportGenerator._write_sheet(wb.create_sheet("New Users"), diff['new'], "user_header")
+        ExcelReportGenerator._write_sheet(wb.create_sheet("Disappeared Users"), diff['gone'], "user_header")
+        wb.save(output_filename)
+        print(f"✓ Diff report saved to: {output_filename}")
+
+    @staticmethod
+    def _adjust_column_widths(worksheet, df):
+        # Widths come from a sample of the frame instead of scanning every written cell
+        sample_rows = ExcelReportGenerator.WIDTH_SAMPLE_ROWS
+        if len(df) > sample_rows:
+            half = sample_rows // 2
+            df = pd.concat([df.head(half), df.iloc[half:].sample(sample_rows - half, random_state=0)])
+        for col_idx, column in enumerate(df.columns, 1):
+            lengths = df[column].astype(str).str.len()
+            max_length = max(len(str(column)), int(lengths.max()) if len(lengths) else 0)
+            adjusted_width = min(max_length + 2, ExcelReportGenerator.MAX_COLUMN_WIDTH)
+            worksheet.column_dimensions[get_column_letter(col_idx)].width = adjusted_width
+
+class CachedNetskopeClient(NetskopeAPIClient):
+    """Client for the report server: windows sit on a fixed UTC grid and their pages are cached.
+
+    Aligning windows to multiples of WINDOW since the epoch lets different
+    ranges share cached windows; only the partial edge windows are range-specific.
+    """
+    SETTLE = timedelta(hours=1)
+
+    def __init__(self, api_url: str, api_token: str, ttl: int = CACHE_TTL_SECONDS, max_windows: int = CACHE_MAX_WINDOWS):
+        super().__init__(api_url, api_token)
+        self.ttl = ttl
+        self.max_windows = max_windows
+        self.cache = OrderedDict()  # (start, end, sort order) -> (pages, fetched at)
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def time_windows(self, start_time, end_time):
+        step = int(self.WINDOW.total_seconds())
+        current, end = int(start_time.timestamp()), int(end_time.timestamp())
+        while current < end:
+            boundary = min((current // step + 1) * step, end)
+            yield datetime.fromtimestamp(current, timezone.utc), datetime.fromtimestamp(boundary, timezone.utc)
+            current = boundary
+
+    def _cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                return None
+            pages, fetched_at = entry
+            # Windows that had fully settled when fetched don't change; recent ones expire after ttl
+            if key[1] > fetched_at - self.SETTLE and datetime.now(timezone.utc) - fetched_at > timedelta(seconds=self.ttl):
+                return None
+            self.cache.move_to_end(key)
+            return pages
+
+    def window_pages(self, chunk_start, chunk_end, sort_order="desc", stop=None):
+        # Whole windows are cached, so early stopping is not applied here
+        key = (chunk_start, chunk_end, sort_order)
+        pages = self._cached(key)
+        if pages is not None:
+            with self.lock:
+                self.hits += 1
+        else:
+            with self.lock:
+                fetch_lock = self.fetch_locks.setdefault(key, threading.Lock())
+            # Concurrent requests for the same window wait for one fetch instead of repeating it
+            with fetch_lock:
+                pages = self._cached(key)
+                if pages is None:
+                    fetched_at = datetime.now(timezone.utc)
+                    pages = list(super().window_pages(chunk_start, chunk_end, sort_order))
+                    with self.lock:
+                        self.misses += 1
+                        self.cache[key] = (pages, fetched_at)
+                        while len(self.cache) > self.max_windows:
+                            self.cache.popitem(last=False)
+                        self.fetch_locks.pop(key, None)
+        yield from pages
+
+class ReportService:
+    """Aggregated report state per requested range, kept warm between HTTP requests."""
+    MAX_RANGES = 20
+
+    def __init__(self, client: CachedNetskopeClient):
+        self.client = client
+        self.ranges = OrderedDict()  # (start, end) -> (df, group_df, built at)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def parse_range(query: Dict[str, List[str]]):
+        """Reads start/end (ISO 8601, UTC if no offset) or days=N; rounded out to whole hours."""
+        def parse(value):
+            parsed = datetime.fromisoformat(value)
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        now = datetime.now(timezone.utc)
+        if 'start' in query:
+            start = parse(query['start'][0])
+            end = parse(query['end'][0]) if 'end' in query else now
+        else:
+            end = now
+            start = end - timedelta(days=float(query.get('days', ['1'])[0]))
+        if end <= start:
+            raise ValueError("end must be after start")
+        if end - start > timedelta(days=30):
+            raise ValueError("range cannot be more than 30 days")
+        start = start.replace(minute=0, second=0, microsecond=0)
+        if end != end.replace(minute=0, second=0, microsecond=0):
+            end = end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        return start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+
+    @staticmethod
+    def parse_filter(query: Dict[str, List[str]]) -> RecordFilter:
+        """Reads group/location/application (repeatable or comma-separated) and min_score/max_score."""
+        def values(name):
+            return [v for item in query.get(name, []) for v in item.split(',') if v.strip()]
+        def number(name):
+            return float(query[name][0]) if name in query else None
+        return RecordFilter(values('group'), values('location'), values('application'),
+                            number('min_score'), number('max_score'))
+
+    def report(self, start_time, end_time, record_filter: Optional[RecordFilter] = None):
+        record_filter = record_filter if record_filter is not None else RecordFilter()
+        key = (start_time, end_time, record_filter.key())
+        with self.lock:
+            entry = self.ranges.get(key)
+            if entry and datetime.now(timezone.utc) - entry[2] <= timedelta(seconds=self.client.ttl):
+                self.ranges.move_to_end(key)
+                return entry[0], entry[1]
+        users = self.client.get_all_users_chunked(start_time, end_time, sort_order=SORT_ORDER, concurrency=CONCURRENCY,
+                                                  record_filter=record_filter)
+        df = UserDataProcessor.process_users(users, record_filter.fields)
+        group_df = UserDataProcessor.create_group_aggregation(df) if not df.empty else pd.DataFrame()
+        with self.lock:
+            self.ranges[key] = (df, group_df, datetime.now(timezone.utc))
+            while len(self.ranges) > self.MAX_RANGES:
+                self.ranges.popitem(last=False)
+        return df, group_df
+
+class ReportRequestHandler(BaseHTTPRequestHandler):
+    """GET /groups, /users?email=, /export?format=xlsx|csv|parquet and /health.
+
+    Report paths take start/end or days, plus optional group, location,
+    application, min_score and max_score filters.
+    """
+    service: ReportService = None
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+    def _send(self, status: int, body: bytes, content_type: str, filename: Optional[str] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if filename:
+            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload):
+        body = payload if isinstance(payload, str) else json.dumps(payload, default=str)
+        self._send(status, body.encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        path, _, query_string = self.path.partition('?')
+        query = parse_qs(query_string)
+        try:
+            if path == '/health':
+                client = self.service.client
+                return self._send_json(200, {'status': 'ok', 'cached_windows': len(client.cache),
+                                             'cache_hits': client.hits, 'cache_misses': client.misses})
+            start_time, end_time = ReportService.parse_range(query)
+            if path not in ('/groups', '/users', '/export'):
+                return self._send_json(404, {'error': f"unknown path {path}"})
+            df, group_df = self.service.report(start_time, end_time, ReportService.parse_filter(query))
+            if path == '/groups':
+                return self._send_json(200, group_df.to_json(orient='records'))
+            if path == '/users':
+                email = RecordMerger.normalize_key(query.get('email', [''])[0])
+                if df.empty:
+                    return self._send_json(404, {'error': f"user {email} not found"})
+                match = df[df['User Email'].str.strip().str.lower() == email]
+                if match.empty:
+                    return self._send_json(404, {'error': f"user {email} not found"})
+                return self._send_json(200, match.to_json(orient='records'))
+            self._export(df, group_df, query.get('format', ['xlsx'])[0], start_time, end_time)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception("Request failed")
+            self._send_json(500, {'error': str(e)})
+
+    def _export(self, df, group_df, fmt, start_time, end_time):
+        name = f"netskope_users_{start_time.strftime('%Y%m%d_%H%M')}_{end_time.strftime('%Y%m%d_%H%M')}"
+        if fmt == 'csv':
+            return self._send(200, df.to_csv(index=False).encode('utf-8'), 'text/csv', f"{name}.csv")
+        if fmt == 'parquet':
+            buffer = io.BytesIO()
+            try:
+                df.to_parquet(buffer, index=False)
+            except ImportError:
+                return self._send_json(501, {'error': "parquet export needs pyarrow or fastparquet"})
+            return self._send(200, buffer.getvalue(), 'application/vnd.apache.parquet', f"{name}.parquet")
+        if fmt != 'xlsx':
+            raise ValueError(f"unsupported format {fmt}")
+        if df.empty:
+            return self._send_json(404, {'error': "no users with Experience Score > 0 in this range"})
+        fd, tmp_path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            ExcelReportGenerator.create_report(df, group_df, tmp_path)
+            with open(tmp_path, 'rb') as f:
+                body = f.read()
+        finally:
+            os.remove(tmp_path)
+        self._send(200, body, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', f"{name}.xlsx")
+
+def serve(host: str = SERVER_HOST, port: int = SERVER_PORT):
+    ReportRequestHandler.service = ReportService(CachedNetskopeClient(API_URL, API_TOKEN))
+    server = ThreadingHTTPServer((host, port), ReportRequestHandler)
+    print(f"{Fore.GREEN}🌐 Report server listening on http://{host}:{port} "
+          f"(/groups, /users?email=, /export?format=xlsx|csv|parquet, /health){Style.RESET_ALL}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\n{Fore.YELLOW}⚠️  Server stopped{Style.RESET_ALL}")
+    finally:
+        server.server_close()
 
 def select_time_range():
     print("\nSelect report time range:")
@@ -315,14 +1561,34 @@ def main():
     print(f"{Fore.MAGENTA}{'Netskope User Report Generator':^60}{Style.RESET_ALL}")
     print(f"{Fore.MAGENTA}{'='*60}{Style.RESET_ALL}")
 
-    tz_choice = select_timezone()
-    sdt, edt = select_time_range()
-    if tz_choice == "utc":
-        sdt = sdt.replace(tzinfo=timezone.utc)
-        edt = edt.replace(tzinfo=timezone.utc)
+    if SERVE_MODE:
+        serve()
+        return
+
+    # Ascending pages let a worst-N fetch stop once nothing left can enter the heap
+    sort_order = "asc" if TOP_N_MODE and TOP_N_EARLY_STOP else SORT_ORDER
+    concurrency = CONCURRENCY
+    if REPLAY_DIR:
+        if not os.path.exists(os.path.join(REPLAY_DIR, 'meta.json')):
+            print(f"\n{Fore.RED}❌ Error: {REPLAY_DIR} has no meta.json; it is not a complete recording{Style.RESET_ALL}")
+            return
+        replay = PageArchive(REPLAY_DIR)
+        meta = replay.read_meta()
+        sdt, edt = datetime.fromisoformat(meta['start']), datetime.fromisoformat(meta['end'])
+        sort_order = meta['sort_order']
+        if meta.get('early_stop'):
+            # A serial replay stops each window no later than the recorded run did
+            concurrency = 1
+        print(f"\n{Fore.CYAN}⏪ Replaying pages recorded {meta.get('recorded_at', '')} from {REPLAY_DIR}{Style.RESET_ALL}")
     else:
-        sdt = sdt.astimezone(timezone.utc)
-        edt = edt.astimezone(timezone.utc)
+        tz_choice = select_timezone()
+        sdt, edt = select_time_range()
+        if tz_choice == "utc":
+            sdt = sdt.replace(tzinfo=timezone.utc)
+            edt = edt.replace(tzinfo=timezone.utc)
+        else:
+            sdt = sdt.astimezone(timezone.utc)
+            edt = edt.astimezone(timezone.utc)
 
     parsed_url = urlparse(API_URL)
     instance_name = parsed_url.netloc
@@ -330,25 +1596,80 @@ def main():
     print(f"   • Instance: {instance_name}")
     print(f"   • API URL: {API_URL}")
     print(f"   • Time Range: {sdt} to {edt} (UTC)")
-    print(f"   • Sort Order: {SORT_ORDER} (by expScore)")
+    print(f"   • Sort Order: {sort_order} (by expScore)")
     print(f"   • Max records per API call: 100 (48 hr window)")
+    print(f"   • Concurrency: {concurrency} window(s), adaptive windows: {'on' if ADAPTIVE_WINDOWS else 'off'}")
+    if TOP_N_MODE:
+        print(f"   • Worst-N mode: {TOP_N_USERS} users, {TOP_N_GROUPS} groups, {TOP_N_PER_KEY} per group/location")
+    else:
+        print(f"   • Duplicate merge strategy: {MERGE_STRATEGY}")
+    record_filter = RecordFilter.from_config()
+    print(f"   • Filter: {record_filter.describe()}")
     if API_TOKEN == "YOUR_API_TOKEN_HERE":
         print(f"\n{Fore.RED}❌ Error: Please update the API_TOKEN at the top of the script{Style.RESET_ALL}")
         return
 
     client = NetskopeAPIClient(API_URL, API_TOKEN)
+    if REPLAY_DIR:
+        mismatch = PageArchive.replay_mismatch(meta, client.MAX_LIMIT, record_filter)
+        if mismatch:
+            print(f"\n{Fore.RED}❌ Error: can't replay {REPLAY_DIR}: {mismatch}{Style.RESET_ALL}")
+            return
+        client.replay_from(replay)
+    elif RECORD_DIR:
+        client.recorder = PageArchive(RECORD_DIR)
+        print(f"   • Recording raw pages to: {RECORD_DIR}")
     try:
         total_start_time = time.time()
-        users = client.get_all_users_chunked(sdt, edt, sort_order=SORT_ORDER)
+        plan = None
+        if REPLAY_DIR:
+            # The recorded windows, not a fresh plan: other window layouts were never fetched
+            plan = PageArchive.plan_from_json(meta['plan'])
+            if plan:
+                FetchPlanner.print_plan(plan)
+        elif DRY_RUN or PLAN_BEFORE_FETCH:
+            planner = FetchPlanner(client)
+            with profiler.stage('plan'):
+                plan = planner.plan(sdt, edt, sort_order=sort_order, concurrency=concurrency, adaptive=ADAPTIVE_WINDOWS)
+            planner.print_plan(plan)
+        if RECORD_DIR:
+            # Written before a dry run returns too, so a probes-only recording still replays its plan
+            client.recorder.write_meta(api_url=API_URL, start=sdt.isoformat(), end=edt.isoformat(),
+                                       sort_order=sort_order, limit=client.MAX_LIMIT, dry_run=DRY_RUN,
+                                       early_stop=TOP_N_MODE and TOP_N_EARLY_STOP and concurrency <= 1,
+                                       top_n_users=TOP_N_USERS, top_n_per_key=TOP_N_PER_KEY,
+                                       filter=record_filter.describe(), plan=PageArchive.plan_to_json(plan))
+        if DRY_RUN:
+            return
+        if TOP_N_MODE:
+            topn = TopNCollector()
+            with profiler.stage('fetch'):
+                client.get_all_users_chunked(sdt, edt, sort_order=sort_order, plan=plan, concurrency=concurrency,
+                                             record_filter=record_filter, topn=topn)
+            if not topn.seen:
+                print(f"\n{Fore.YELLOW}⚠️  No users found for the specified time range{Style.RESET_ALL}")
+                return
+            output_filename = f"netskope_worst_users_{datetime.now().strftime('%Y%m%d_%H%M')}.xlsx"
+            with profiler.stage('create_report'):
+                ExcelReportGenerator.create_top_n_report(topn, output_filename, record_filter.fields)
+            print(f"\n{Fore.GREEN}✓ Worst-N report completed in {time.time() - total_start_time:.1f} seconds: "
+                  f"{output_filename}{Style.RESET_ALL}\n")
+            return
+        timeseries = TimeSeriesAggregator()
+        with profiler.stage('fetch'):
+            users = client.get_all_users_chunked(sdt, edt, sort_order=sort_order, plan=plan, concurrency=concurrency,
+                                                 timeseries=timeseries, record_filter=record_filter)
         if not users:
             print(f"\n{Fore.YELLOW}⚠️  No users found for the specified time range{Style.RESET_ALL}")
             return
         processor = UserDataProcessor()
-        df = processor.process_users(users)
+        with profiler.stage('process_users'):
+            df = processor.process_users(users, record_filter.fields)
         if df.empty:
-            print(f"\n{Fore.YELLOW}⚠️  No users with Experience Score > 0 in this period.{Style.RESET_ALL}")
+            print(f"\n{Fore.YELLOW}⚠️  No users with Experience Score > 0 matching the filter in this period.{Style.RESET_ALL}")
             return
-        group_df = processor.create_group_aggregation(df)
+        with profiler.stage('create_group_aggregation'):
+            group_df = processor.create_group_aggregation(df)
         print(f"\n{Fore.CYAN}📊 Data Summary:{Style.RESET_ALL}")
         print(f"   • Total unique users: {len(df):,}")
         print(f"   • Unique email addresses: {df['User Email'].nunique():,}")
@@ -357,19 +1678,46 @@ def main():
         print(f"   • Unique groups: {len(group_df):,}")
         timestamp = datetime.now().strftime("%Y%m%d_%H%M")
         output_filename = f"netskope_users_{timestamp}.xlsx"
+        with profiler.stage('trends'):
+            trend_df = timeseries.to_frame()
+            trend_filename = TimeSeriesAggregator.write_columnar(trend_df, f"netskope_trends_{timestamp}.parquet")
         report_generator = ExcelReportGenerator()
-        report_generator.create_report(df, group_df, output_filename)
+        with profiler.stage('create_report'):
+            report_generator.create_report(df, group_df, output_filename, trend_df=trend_df)
+        if DIFF_MODE and REPLAY_DIR:
+            # Offline reprocessing must not move the live baseline or diff old data against it
+            print(f"\n{Fore.YELLOW}ℹ️  Replay: skipping the diff and leaving the snapshot baseline untouched{Style.RESET_ALL}")
+        elif DIFF_MODE:
+            with profiler.stage('diff'):
+                snapshot = RunSnapshot.build(df, group_df, sdt, edt, record_filter)
+                snapshot_file = RunSnapshot.scope_path(SNAPSHOT_FILE, snapshot['scope'])
+                previous = RunSnapshot.load(snapshot_file)
+                if previous and previous.get('scope') != snapshot['scope']:
+                    print(f"\n{Fore.YELLOW}⚠️  {snapshot_file} covers {previous.get('scope')}, not "
+                          f"{snapshot['scope']}; skipping the diff{Style.RESET_ALL}")
+                elif previous:
+                    diff = RunSnapshot.diff(previous, snapshot)
+                    RunSnapshot.print_diff(diff, previous)
+                    report_generator.create_diff_report(diff, f"netskope_diff_{timestamp}.xlsx")
+                else:
+                    print(f"\n{Fore.YELLOW}ℹ️  No previous snapshot for this range length and filter; "
+                          f"the next matching run will be diffed against this one{Style.RESET_ALL}")
+                if not previous or previous.get('scope') == snapshot['scope']:
+                    RunSnapshot.save(snapshot, snapshot_file)
         total_elapsed = time.time() - total_start_time
         print(f"\n{Fore.GREEN}{'='*60}{Style.RESET_ALL}")
         print(f"{Fore.GREEN}✓ Report generation completed successfully!{Style.RESET_ALL}")
         print(f"{Fore.GREEN}📊 Total execution time: {total_elapsed:.1f} seconds{Style.RESET_ALL}")
         print(f"{Fore.GREEN}📄 Output file: {output_filename}{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}📈 Trend data: {trend_filename}{Style.RESET_ALL}")
         print(f"{Fore.GREEN}{'='*60}{Style.RESET_ALL}\n")
     except KeyboardInterrupt:
         print(f"\n\n{Fore.YELLOW}⚠️  Process interrupted by user{Style.RESET_ALL}")
     except Exception as e:
         print(f"\n{Fore.RED}❌ Error generating report: {e}{Style.RESET_ALL}")
         raise
+    finally:
+        profiler.close()
 
 if __name__ == "__main__":
     main()